@@ -0,0 +1,29 @@
+import sys
+sys.path.append("./src")
+import json
+import time
+from nltk.tokenize import sent_tokenize
+from utils import *
+
+# Compare the NLTK + whitespace path with the CJK-aware segmenter on English, Chinese and mixed text
+english = open("./data/input_files/Artificial_Intelligence_Wikipedia.txt", encoding="utf-8").read()
+with open("./data/input_files/ChineseNewsExample.json", encoding="utf-8") as file:
+    chinese = "".join(json.loads(line)["title"] + "。" for line in file if line.strip())
+corpora = {"english": english, "chinese": chinese, "mixed": chinese[:len(chinese) // 2] + english[:len(english) // 4] + chinese[len(chinese) // 2:]}
+
+def nltk_path(text):
+    sentences = sent_tokenize(text)
+    return sentences, [len(sentence.split()) for sentence in sentences]
+
+def cjk_aware_path(text):
+    sentences = split_sentences(text)
+    return sentences, [count_words(sentence) for sentence in sentences]
+
+repeat = 5
+for name, text in corpora.items():
+    for path_name, path in [("nltk", nltk_path), ("cjk_aware", cjk_aware_path)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            sentences, lengths = path(text)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{name:8s} {path_name:10s} chars: {len(text):8d}  sentences: {len(sentences):6d}  max length: {max(lengths, default=0):6d}  total length: {sum(lengths):8d}  time: {elapsed * 1000:8.2f} ms")
@@ -0,0 +1,52 @@
+import sys
+sys.path.append("./src")
+import re
+import json
+import time
+from utils import *
+
+# Compare the old nested-brace regex with the single-pass scanner on large model outputs
+REGEX_PATTERN = r'\{(?:[^{}]|(?:\{(?:[^{}]|(?:\{[^{}]*\})*)*\})*)*\}'
+
+def regex_path(text):
+    matches = re.findall(REGEX_PATTERN, text)
+    return matches[-1] if matches else None
+
+def scanner_path(text):
+    scanner = JSONScanner()
+    scanner.feed(text)
+    return scanner.last_object
+
+def streamed_scanner_path(text, chunk_size=16):
+    scanner = JSONScanner()
+    for start in range(0, len(text), chunk_size):
+        scanner.feed(text[start:start + chunk_size])
+    return scanner.last_object
+
+entities = {"entity_list": [{"name": f"Entity {i}", "type": "组织", "attributes": {"source": {"span": [i, i + 5]}}} for i in range(5000)]}
+deep = {"level": 0}
+for depth in range(1, 30):
+    deep = {"level": depth, "child": deep}
+flat = {"entity_list": [{"name": f"Entity {i}", "type": "Person"} for i in range(20000)]}
+triples = {"triple_list": [{"head": "A", "relation": "r", "tail": "B"}]}
+corpora = {
+    "flat": ("Here is the extraction result:\n" + json.dumps(flat, ensure_ascii=False) + "\nDone.", flat),
+    "nested": ("```json\n" + json.dumps(entities, ensure_ascii=False) + "\n```", entities),
+    "deep": ("Result: " + json.dumps(deep), deep),
+    "brace_prose": ("Reasoning about {sets} and {maps} " * 5000 + json.dumps(triples), triples),
+    # A response cut off by max_tokens: the regex backtracks exponentially in the number of entities
+    "truncated": ('{"entity_list": [' + '{"name": "x", "span": {"s": 1}}, ' * 16, {"name": "x", "span": {"s": 1}}),
+}
+
+repeat = 3
+for name, (text, expected) in corpora.items():
+    for path_name, path in [("regex", regex_path), ("scanner", scanner_path), ("streamed", streamed_scanner_path)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = path(text)
+        elapsed = (time.perf_counter() - start) / repeat
+        try:
+            parsed = "parsed" if result is not None and json.loads(result, strict=False) == expected else "partial"
+        except json.JSONDecodeError:
+            parsed = "partial"
+        print(f"{name:12s} {path_name:9s} chars: {len(text):9d}  result: {parsed:8s} time: {elapsed * 1000:9.2f} ms")
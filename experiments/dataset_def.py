@@ -54,7 +54,8 @@ class NERDataset(BaseDataset):
                 for attempt in range(self.retry):
                     pred_result, pred_detailed, _, _ = pipeline.get_extract_result(task=self.task, text=item['sentence'], constraint=self.schema, mode=mode, truth=truth, update_case=update_case)
                     try:
-                        pred_result = pred_result['entity_list']
+                        # An empty answer is a valid prediction; only non-JSON output is retried
+                        pred_result = pred_result.get('entity_list', []) if isinstance(pred_result, dict) else pred_result['entity_list']
                         pred_set = dict_list_to_set(pred_result)
                         break
                     except Exception as e:
@@ -83,6 +84,9 @@ class NERDataset(BaseDataset):
                 print(f"idx: {num_items}")
                 pass
 
+        # wait for cases learned in the background
+        pipeline.case_repo.flush()
+
         # calculate overall metrics
         if num_items > 0:
             avg_precision = total_precision / num_items
@@ -134,7 +138,8 @@ class REDataset(BaseDataset):
                 for attempt in range(self.retry):
                     pred_result, pred_detailed, _, _ = pipeline.get_extract_result(task=self.task, text=item['sentence'], constraint=self.schema, mode=mode, truth=truth, update_case=update_case)
                     try:
-                        pred_result = pred_result['relation_list']
+                        # An empty answer is a valid prediction; only non-JSON output is retried
+                        pred_result = pred_result.get('relation_list', []) if isinstance(pred_result, dict) else pred_result['relation_list']
                         pred_set = dict_list_to_set(pred_result)
                         break
                     except Exception as e:
@@ -163,6 +168,9 @@ class REDataset(BaseDataset):
                 print(f"idx: {num_items}")
                 pass
 
+        # wait for cases learned in the background
+        pipeline.case_repo.flush()
+
         # calculate overall metrics
         if num_items > 0:
             avg_precision = total_precision / num_items
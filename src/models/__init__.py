@@ -1,3 +1,5 @@
 from .llm_def import *
 from .prompt_example import *
 from .prompt_template import *
+from .llm_cache import *
+from .llm_batch import *
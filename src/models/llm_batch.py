@@ -0,0 +1,89 @@
+"""
+Request Coalescing.
+Supports:
+- Merging concurrent get_chat_response calls from different threads into get_chat_responses batches
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from .llm_def import BaseEngine
+
+class BatchedEngine(BaseEngine):
+    def __init__(self, llm: BaseEngine, max_wait: float = 0.05):
+        self.llm = llm
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    # Everything not defined here (name, temperature, tokenizer, ...) is read from the wrapped engine
+    def __getattr__(self, attr):
+        if attr == "llm":
+            raise AttributeError(attr)
+        return getattr(self.llm, attr)
+
+    @property
+    def native_batching(self):
+        return self.llm.native_batching
+
+    @property
+    def supports_structured_output(self):
+        return self.llm.supports_structured_output
+
+    def set_hyperparameter(self, temperature: float = 0.2, top_p: float = 0.9, max_tokens: int = 1024):
+        self.llm.set_hyperparameter(temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+
+    def set_structured_output(self, enabled: bool = True):
+        self.llm.set_structured_output(enabled)
+
+    def set_streaming(self, enabled: bool = True, on_chunk=None):
+        self.llm.set_streaming(enabled, on_chunk)
+
+    def set_batch_size(self, batch_size: int = 8):
+        self.llm.set_batch_size(batch_size)
+
+    def set_concurrency(self, concurrency: int = 16):
+        self.llm.set_concurrency(concurrency)
+
+    def __ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self.__run, daemon=True)
+                self._worker.start()
+
+    def __run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Wait briefly for other threads so their prompts share the forward pass
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < getattr(self.llm, "batch_size", 8):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # Prompts constrained to different schemas cannot share a generate call
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+            for schema, group in groups.items():
+                try:
+                    responses = self.llm.get_chat_responses([prompt for prompt, _, _ in group], schema=schema)
+                    for (_, _, future), response in zip(group, responses):
+                        future.set_result(response)
+                except Exception as e:
+                    for _, _, future in group:
+                        future.set_exception(e)
+
+    def get_chat_response(self, prompt, schema=None):
+        future = Future()
+        self._queue.put((prompt, schema, future))
+        self.__ensure_worker()
+        return future.result()
+
+    def get_chat_responses(self, prompts: list, schema=None):
+        return self.llm.get_chat_responses(prompts, schema=schema)
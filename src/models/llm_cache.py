@@ -0,0 +1,177 @@
+"""
+Persistent LLM Response Cache.
+Supports:
+- SQLite (WAL) storage shared by parallel workers and across runs
+- Size-bounded LRU eviction
+- Hit/miss counters
+- Read-only replay mode
+"""
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from .llm_def import BaseEngine
+
+class CachedEngine(BaseEngine):
+    def __init__(self, llm: BaseEngine, cache_path: str = "llm_cache.sqlite", max_size_mb: float = 512, replay: bool = False):
+        self.llm = llm
+        self.cache_path = cache_path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        if not replay:
+            cache_dir = os.path.dirname(os.path.abspath(cache_path))
+            os.makedirs(cache_dir, exist_ok=True)
+            conn = self._connection()
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+            # Running total of cached bytes, kept by triggers so writes never scan the table
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (id INTEGER PRIMARY KEY CHECK (id = 0), total_size INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO cache_meta (id, total_size) SELECT 0, COALESCE(SUM(size), 0) FROM cache")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON cache BEGIN UPDATE cache_meta SET total_size = total_size + new.size WHERE id = 0; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON cache BEGIN UPDATE cache_meta SET total_size = total_size - old.size WHERE id = 0; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS cache_size_update AFTER UPDATE OF size ON cache BEGIN UPDATE cache_meta SET total_size = total_size + new.size - old.size WHERE id = 0; END")
+            conn.commit()
+
+    # Everything not defined here (name, temperature, tokenizer, ...) is read from the wrapped engine
+    def __getattr__(self, attr):
+        if attr == "llm":
+            raise AttributeError(attr)
+        return getattr(self.llm, attr)
+
+    @property
+    def native_batching(self):
+        return self.llm.native_batching
+
+    @property
+    def supports_structured_output(self):
+        return self.llm.supports_structured_output
+
+    def set_hyperparameter(self, temperature: float = 0.2, top_p: float = 0.9, max_tokens: int = 1024):
+        self.llm.set_hyperparameter(temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+
+    def set_structured_output(self, enabled: bool = True):
+        self.llm.set_structured_output(enabled)
+
+    def set_streaming(self, enabled: bool = True, on_chunk=None):
+        self.llm.set_streaming(enabled, on_chunk)
+
+    def set_batch_size(self, batch_size: int = 8):
+        self.llm.set_batch_size(batch_size)
+
+    def set_concurrency(self, concurrency: int = 16):
+        self.llm.set_concurrency(concurrency)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.replay:
+                uri = f"file:{os.path.abspath(self.cache_path)}?mode=ro"
+                conn = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.cache_path, timeout=30, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _key(self, prompt, schema=None):
+        model = getattr(self.llm, "model_id", None) or getattr(self.llm, "model", None)
+        if not isinstance(model, str):
+            model = self.llm.name
+        fields = [model, prompt, self.llm.temperature, self.llm.top_p, self.llm.max_tokens]
+        if schema is not None and self.llm.structured_output and self.llm.supports_structured_output:
+            # Constrained and free-text answers to the same prompt differ
+            fields.append(schema.model_json_schema())
+        payload = json.dumps(fields, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        conn = self._connection()
+        row = conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            if self.replay:
+                raise KeyError(f"Replay mode: no cached response for key {key}.")
+            return None
+        if not self.replay:
+            conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        return json.loads(row[0])
+
+    def _store(self, key, response):
+        if self.replay or response is None:
+            return
+        value = json.dumps(response, ensure_ascii=False)
+        conn = self._connection()
+        # An upsert rather than INSERT OR REPLACE, so the size triggers see the overwrite as an update
+        conn.execute("INSERT INTO cache (key, response, size, last_access) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, last_access = excluded.last_access",
+                     (key, value, len(value.encode("utf-8")), time.time()))
+        conn.commit()
+        self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT total_size FROM cache_meta WHERE id = 0").fetchone()[0]
+        if total <= self.max_size:
+            return
+        # Drop the least recently used entries until the cache fits again
+        excess = total - self.max_size
+        freed = 0
+        stale_keys = []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY last_access"):
+            stale_keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", stale_keys)
+        conn.commit()
+
+    def get_chat_response(self, prompt, schema=None):
+        key = self._key(prompt, schema)
+        response = self._lookup(key)
+        if response is None:
+            response = self.llm.get_chat_response(prompt, schema=schema)
+            self._store(key, response)
+        return response
+
+    def get_chat_responses(self, prompts: list, schema=None):
+        keys = [self._key(prompt, schema) for prompt in prompts]
+        responses = [self._lookup(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            generated = self.llm.get_chat_responses([prompts[i] for i in missing], schema=schema)
+            for i, response in zip(missing, generated):
+                responses[i] = response
+                self._store(keys[i], response)
+        return responses
+
+    async def aget_chat_response(self, prompt, schema=None):
+        key = self._key(prompt, schema)
+        response = self._lookup(key)
+        if response is None:
+            response = await self.llm.aget_chat_response(prompt, schema=schema)
+            self._store(key, response)
+        return response
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0.0}
+
+    def clear(self):
+        if self.replay:
+            return
+        conn = self._connection()
+        conn.execute("DELETE FROM cache")
+        conn.commit()
@@ -6,11 +6,16 @@ Supports:
 """
 
 from transformers import pipeline
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, AutoConfig, GenerationConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, AutoConfig, GenerationConfig, LogitsProcessorList, StoppingCriteriaList
 import torch
 import openai
 import os
-from openai import OpenAI
+import re
+import asyncio
+import itertools
+from openai import OpenAI, AsyncOpenAI
+from .llm_grammar import JSONLogitsProcessor, JSONStoppingCriteria
+from utils.text_scan import JSONScanner, answer_closed, CJK_CHAR_PATTERN
 
 # Set proxy for requests
 os.environ['http_proxy'] = 'http://127.0.0.1:7890'
@@ -18,24 +23,219 @@ os.environ['https_proxy'] = 'http://127.0.0.1:7890'
 
 # The inferencing code is taken from the official documentation
 
+# Identifies each streamed request to on_chunk, whose calls may interleave across threads
+REQUEST_IDS = itertools.count()
+
 class BaseEngine:
+    native_batching = False # True when get_chat_responses runs prompts in one forward pass
+    supports_structured_output = False # True when a response can be constrained to a pydantic schema
+
     def __init__(self, model_name_or_path: str):
         self.name = None
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, trust_remote_code=True)
         self.temperature = 0.2
         self.top_p = 0.9
         self.max_tokens = 1024
+        self.context_length = 8192
+        self.batch_size = 8
+        self.concurrency = 16
+        self.structured_output = False
+        self.stream = False
+        self.on_chunk = None
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         raise NotImplementedError
 
+    def count_tokens(self, text: str):
+        return self.count_tokens_batch([text])[0]
+
+    def count_tokens_batch(self, texts: list):
+        tokenizer = getattr(self, "tokenizer", None)
+        if tokenizer is None:
+            # No local tokenizer for API models: roughly one token per CJK character and four characters per token otherwise
+            counts = []
+            for text in texts:
+                cjk_count = len(CJK_CHAR_PATTERN.findall(text))
+                counts.append(cjk_count + (len(text) - cjk_count) // 4 + 1)
+            return counts
+        # One call lets a fast tokenizer encode the whole batch natively
+        return [len(input_ids) for input_ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def get_chat_responses(self, prompts: list, schema=None):
+        # Engines that cannot batch fall back to one request per prompt
+        return [self.get_chat_response(prompt, schema=schema) for prompt in prompts]
+
+    async def aget_chat_response(self, prompt, schema=None):
+        # Engines without a native async client run the blocking call in a worker thread
+        return await asyncio.to_thread(self.get_chat_response, prompt, schema=schema)
+
+    async def aget_chat_responses(self, prompts: list, schema=None):
+        return await asyncio.gather(*(self.aget_chat_response(prompt, schema=schema) for prompt in prompts))
+
+    def _get_semaphore(self):
+        # asyncio primitives are bound to the loop they are first used on, so rebuild per loop
+        loop = asyncio.get_running_loop()
+        if getattr(self, "_semaphore_loop", None) is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def _generation_kwargs(self, model, schema=None, eos_token_ids=None):
+        # Fresh processors per generate call, since they track each row's state
+        kwargs = {}
+        if schema is not None and self.structured_output and self.supports_structured_output:
+            # Schema-constrained decoding
+            if eos_token_ids is None:
+                eos_token_ids = model.generation_config.eos_token_id
+            eos_token_ids = list(eos_token_ids) if isinstance(eos_token_ids, (list, tuple)) else [eos_token_ids]
+            eos_token_ids.append(self.tokenizer.eos_token_id)
+            kwargs["logits_processor"] = LogitsProcessorList([JSONLogitsProcessor(self.tokenizer, schema, eos_token_ids)])
+        if self.stream:
+            # Stop each row once its JSON answer closes instead of running on to max_new_tokens;
+            # on_chunk fires whenever the call generates a single response, including a batch of one
+            kwargs["stopping_criteria"] = StoppingCriteriaList([JSONStoppingCriteria(self.tokenizer, schema, self.on_chunk, next(REQUEST_IDS))])
+        return kwargs
+
+    def _response_format(self, schema=None):
+        # OpenAI-compatible engines: a JSON schema built from the pydantic class, or plain JSON mode where only that is supported
+        mode = getattr(self, "response_format_mode", None)
+        if schema is None or mode is None or not (self.structured_output and self.supports_structured_output):
+            return None
+        if mode == "json_schema":
+            return {"type": "json_schema", "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema()}}
+        return {"type": "json_object"}
+
+    def _rejects_response_format(self, error):
+        # Only errors about response_format itself downgrade it; e.g. a context-length overflow is raised as is
+        return getattr(error, "param", None) == "response_format" or "response_format" in str(error)
+
+    def _downgrade_response_format(self, error):
+        # Servers that reject a response_format get the next weaker one, down to none, for the rest of the session
+        fallback = {"json_schema": "json_object", "json_object": None}
+        print(f"{self.name} does not accept response_format {self.response_format_mode}, falling back to {fallback[self.response_format_mode]}: {error}")
+        self.response_format_mode = fallback[self.response_format_mode]
+
+    def _stream_step(self, chunk, state):
+        # Accumulate one streamed chunk; True once the JSON answer has closed and the request can be cancelled
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            return False
+        state["text"] += delta
+        if self.on_chunk is not None:
+            self.on_chunk(state["request_id"], delta, state["text"])
+        return state["scanner"].feed(delta) and answer_closed(state["text"], state["scanner"], state["schema"])
+
+    def _chat_completion(self, input, schema=None):
+        while True:
+            response_format = self._response_format(schema)
+            extra_kwargs = {"response_format": response_format} if response_format is not None else {}
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "user", "content": input},
+                    ],
+                    stream=self.stream,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    stop=None,
+                    **extra_kwargs
+                )
+                if not self.stream:
+                    return response.choices[0].message.content
+                state = {"text": "", "scanner": JSONScanner(), "schema": schema, "request_id": next(REQUEST_IDS)}
+                try:
+                    for chunk in response:
+                        if self._stream_step(chunk, state):
+                            break
+                finally:
+                    # Closing the stream early cancels the rest of the generation
+                    response.close()
+                return state["text"]
+            except openai.BadRequestError as e:
+                if response_format is None or not self._rejects_response_format(e):
+                    raise
+                self._downgrade_response_format(e)
+
+    async def _achat_completion(self, input, schema=None):
+        while True:
+            response_format = self._response_format(schema)
+            extra_kwargs = {"response_format": response_format} if response_format is not None else {}
+            try:
+                async with self._get_semaphore():
+                    response = await self.async_client.chat.completions.create(
+                        model=self.model,
+                        messages=[
+                            {"role": "user", "content": input},
+                        ],
+                        stream=self.stream,
+                        temperature=self.temperature,
+                        max_tokens=self.max_tokens,
+                        stop=None,
+                        **extra_kwargs
+                    )
+                    if not self.stream:
+                        return response.choices[0].message.content
+                    state = {"text": "", "scanner": JSONScanner(), "schema": schema, "request_id": next(REQUEST_IDS)}
+                    try:
+                        async for chunk in response:
+                            if self._stream_step(chunk, state):
+                                break
+                    finally:
+                        await response.close()
+                return state["text"]
+            except openai.BadRequestError as e:
+                if response_format is None or not self._rejects_response_format(e):
+                    raise
+                self._downgrade_response_format(e)
+
+    def _batch_generate(self, model, texts: list, add_special_tokens: bool = False, schema=None, **generate_kwargs):
+        # Sort prompts by token length and cut them into buckets of batch_size,
+        # so each bucket is left-padded to a similar length and run in one generate call
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+        lengths = [len(ids) for ids in self.tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        responses = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start + self.batch_size]
+            model_inputs = self.tokenizer([texts[i] for i in bucket], return_tensors="pt", padding=True, add_special_tokens=add_special_tokens).to(self.device)
+            extra_kwargs = self._generation_kwargs(model, schema, generate_kwargs.get("eos_token_id"))
+            with torch.no_grad():
+                model_outputs = model.generate(**model_inputs, pad_token_id=self.tokenizer.pad_token_id, **generate_kwargs, **extra_kwargs)
+            model_outputs = model_outputs[:, model_inputs["input_ids"].shape[1]:]
+            for idx, response in zip(bucket, self.tokenizer.batch_decode(model_outputs, skip_special_tokens=True)):
+                responses[idx] = response.strip()
+        return responses
+
     def set_hyperparameter(self, temperature: float = 0.2, top_p: float = 0.9, max_tokens: int = 1024):
         self.temperature = temperature
         self.top_p = top_p
         self.max_tokens = max_tokens
 
+    def set_structured_output(self, enabled: bool = True):
+        # Only takes effect on engines that support it; others keep sampling free text
+        self.structured_output = enabled
+
+    def set_streaming(self, enabled: bool = True, on_chunk=None):
+        # Stream responses, stop once the JSON answer closes, and report each chunk as on_chunk(request_id, delta, text);
+        # chunks of concurrent requests interleave, so partial results are rebuilt per request_id
+        self.stream = enabled
+        self.on_chunk = on_chunk
+
+    def set_batch_size(self, batch_size: int = 8):
+        self.batch_size = max(1, batch_size)
+
+    def set_concurrency(self, concurrency: int = 16):
+        self.concurrency = max(1, concurrency)
+        self._semaphore_loop = None
+
 class LLaMA(BaseEngine):
+    native_batching = True
+    supports_structured_output = True
+
     def __init__(self, model_name_or_path: str):
         super().__init__(model_name_or_path)
         self.name = "LLaMA"
@@ -50,8 +250,9 @@ class LLaMA(BaseEngine):
             self.pipeline.tokenizer.eos_token_id,
             self.pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
         ]
+        self.context_length = getattr(self.pipeline.model.config, "max_position_embeddings", self.context_length)
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         messages = [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt},
@@ -63,10 +264,33 @@ class LLaMA(BaseEngine):
             do_sample=True,
             temperature=self.temperature,
             top_p=self.top_p,
+            **self._generation_kwargs(self.pipeline.model, schema, self.terminators),
         )
         return outputs[0]["generated_text"][-1]['content'].strip()
 
+    def get_chat_responses(self, prompts: list, schema=None):
+        texts = [
+            self.tokenizer.apply_chat_template([
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt},
+            ], tokenize=False, add_generation_prompt=True)
+            for prompt in prompts
+        ]
+        return self._batch_generate(
+            self.pipeline.model,
+            texts,
+            schema=schema,
+            max_new_tokens=self.max_tokens,
+            eos_token_id=self.terminators,
+            do_sample=True,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+
 class Qwen(BaseEngine):
+    native_batching = True
+    supports_structured_output = True
+
     def __init__(self, model_name_or_path: str):
         super().__init__(model_name_or_path)
         self.name = "Qwen"
@@ -76,8 +300,9 @@ class Qwen(BaseEngine):
             torch_dtype="auto",
             device_map="auto"
         )
+        self.context_length = getattr(self.model.config, "max_position_embeddings", self.context_length)
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         messages = [
             {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
             {"role": "user", "content": prompt}
@@ -92,7 +317,8 @@ class Qwen(BaseEngine):
             **model_inputs,
             temperature=self.temperature,
             top_p=self.top_p,
-            max_new_tokens=self.max_tokens
+            max_new_tokens=self.max_tokens,
+            **self._generation_kwargs(self.model, schema)
         )
         generated_ids = [
             output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
@@ -101,7 +327,27 @@ class Qwen(BaseEngine):
 
         return response
 
+    def get_chat_responses(self, prompts: list, schema=None):
+        texts = [
+            self.tokenizer.apply_chat_template([
+                {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ], tokenize=False, add_generation_prompt=True)
+            for prompt in prompts
+        ]
+        return self._batch_generate(
+            self.model,
+            texts,
+            schema=schema,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_new_tokens=self.max_tokens
+        )
+
 class MiniCPM(BaseEngine):
+    native_batching = True
+    supports_structured_output = True
+
     def __init__(self, model_name_or_path: str):
         super().__init__(model_name_or_path)
         self.name = "MiniCPM"
@@ -112,8 +358,9 @@ class MiniCPM(BaseEngine):
             device_map="auto",
             trust_remote_code=True
         )
+        self.context_length = getattr(self.model.config, "max_position_embeddings", self.context_length)
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         messages = [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt}
@@ -123,7 +370,8 @@ class MiniCPM(BaseEngine):
             model_inputs,
             temperature=self.temperature,
             top_p=self.top_p,
-            max_new_tokens=self.max_tokens
+            max_new_tokens=self.max_tokens,
+            **self._generation_kwargs(self.model, schema)
         )
         output_token_ids = [
             model_outputs[i][len(model_inputs[i]):] for i in range(len(model_inputs))
@@ -132,7 +380,27 @@ class MiniCPM(BaseEngine):
 
         return response
 
+    def get_chat_responses(self, prompts: list, schema=None):
+        texts = [
+            self.tokenizer.apply_chat_template([
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ], tokenize=False, add_generation_prompt=True)
+            for prompt in prompts
+        ]
+        return self._batch_generate(
+            self.model,
+            texts,
+            schema=schema,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_new_tokens=self.max_tokens
+        )
+
 class ChatGLM(BaseEngine):
+    native_batching = True
+    supports_structured_output = True
+
     def __init__(self, model_name_or_path: str):
         super().__init__(model_name_or_path)
         self.name = "ChatGLM"
@@ -144,8 +412,9 @@ class ChatGLM(BaseEngine):
             low_cpu_mem_usage=True,
             trust_remote_code=True
         )
+        self.context_length = getattr(self.model.config, "seq_length", self.context_length)
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         messages = [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt}
@@ -155,14 +424,34 @@ class ChatGLM(BaseEngine):
             **model_inputs,
             temperature=self.temperature,
             top_p=self.top_p,
-            max_new_tokens=self.max_tokens
+            max_new_tokens=self.max_tokens,
+            **self._generation_kwargs(self.model, schema)
         )
         model_outputs = model_outputs[:, model_inputs['input_ids'].shape[1]:]
         response = self.tokenizer.batch_decode(model_outputs, skip_special_tokens=True)[0].strip()
 
         return response
 
+    def get_chat_responses(self, prompts: list, schema=None):
+        texts = [
+            self.tokenizer.apply_chat_template([
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ], tokenize=False, add_generation_prompt=True)
+            for prompt in prompts
+        ]
+        return self._batch_generate(
+            self.model,
+            texts,
+            schema=schema,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_new_tokens=self.max_tokens
+        )
+
 class OneKE(BaseEngine):
+    native_batching = True
+
     def __init__(self, model_name_or_path: str):
         super().__init__(model_name_or_path)
         self.name = "OneKE"
@@ -184,8 +473,9 @@ class OneKE(BaseEngine):
             torch_dtype=torch.bfloat16,
             trust_remote_code=True,
         )
+        self.context_length = getattr(self.model.config, "max_position_embeddings", self.context_length)
 
-    def get_chat_response(self, prompt):
+    def get_chat_response(self, prompt, schema=None):
         system_prompt = '<<SYS>>\nYou are a helpful assistant. 你是一个乐于助人的助手。\n<</SYS>>\n\n'
         sintruct = '[INST] ' + system_prompt + prompt + '[/INST]'
         input_ids = self.tokenizer.encode(prompt, return_tensors='pt')
@@ -198,7 +488,20 @@ class OneKE(BaseEngine):
 
         return response
 
+    def get_chat_responses(self, prompts: list, schema=None):
+        system_prompt = '<<SYS>>\nYou are a helpful assistant. 你是一个乐于助人的助手。\n<</SYS>>\n\n'
+        texts = ['[INST] ' + system_prompt + prompt + '[/INST]' for prompt in prompts]
+        return self._batch_generate(
+            self.model,
+            texts,
+            add_special_tokens=True,
+            generation_config=GenerationConfig(max_length=1024, max_new_tokens=512, eos_token_id=self.tokenizer.eos_token_id)
+        )
+
 class ChatGPT(BaseEngine):
+    supports_structured_output = True
+    response_format_mode = "json_schema"
+
     def __init__(self, model_name_or_path: str, api_key: str, base_url=openai.base_url):
         self.name = "ChatGPT"
         self.model = model_name_or_path
@@ -206,26 +509,34 @@ class ChatGPT(BaseEngine):
         self.temperature = 0.2
         self.top_p = 0.9
         self.max_tokens = 4096 # Close source model
+        self.context_length = 128000
         if api_key != "":
             self.api_key = api_key
         else:
             self.api_key = os.environ["OPENAI_API_KEY"]
+        self.concurrency = 16
+        self.structured_output = False
+        self.stream = False
+        self.on_chunk = None
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        self._async_client = None
 
-    def get_chat_response(self, input):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "user", "content": input},
-            ],
-            stream=False,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            stop=None
-        )
-        return response.choices[0].message.content
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        return self._async_client
+
+    def get_chat_response(self, input, schema=None):
+        return self._chat_completion(input, schema)
+
+    async def aget_chat_response(self, input, schema=None):
+        return await self._achat_completion(input, schema)
 
 class DeepSeek(BaseEngine):
+    supports_structured_output = True
+    response_format_mode = "json_object" # DeepSeek only offers JSON mode
+
     def __init__(self, model_name_or_path: str, api_key: str, base_url="https://api.deepseek.com"):
         self.name = "DeepSeek"
         self.model = model_name_or_path
@@ -233,26 +544,34 @@ class DeepSeek(BaseEngine):
         self.temperature = 0.2
         self.top_p = 0.9
         self.max_tokens = 4096 # Close source model
+        self.context_length = 64000
         if api_key != "":
             self.api_key = api_key
         else:
             self.api_key = os.environ["DEEPSEEK_API_KEY"]
+        self.concurrency = 16
+        self.structured_output = False
+        self.stream = False
+        self.on_chunk = None
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        self._async_client = None
 
-    def get_chat_response(self, input):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "user", "content": input},
-            ],
-            stream=False,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            stop=None
-        )
-        return response.choices[0].message.content
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        return self._async_client
+
+    def get_chat_response(self, input, schema=None):
+        return self._chat_completion(input, schema)
+
+    async def aget_chat_response(self, input, schema=None):
+        return await self._achat_completion(input, schema)
 
 class LocalServer(BaseEngine):
+    supports_structured_output = True
+    response_format_mode = "json_schema" # vLLM serves it with guided decoding
+
     def __init__(self, model_name_or_path: str, base_url="http://localhost:8000/v1"):
         self.name = model_name_or_path.split('/')[-1]
         self.model = model_name_or_path
@@ -260,22 +579,32 @@ class LocalServer(BaseEngine):
         self.temperature = 0.2
         self.top_p = 0.9
         self.max_tokens = 1024
+        self.context_length = 32768 # --max-model-len default in vllm_serve.py
         self.api_key = "EMPTY_API_KEY"
+        self.concurrency = 16
+        self.structured_output = False
+        self.stream = False
+        self.on_chunk = None
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        return self._async_client
+
+    def get_chat_response(self, input, schema=None):
+        try:
+            return self._chat_completion(input, schema)
+        except ConnectionError:
+            print("Error: Unable to connect to the server. Please check if the vllm service is running and the port is 8080.")
+        except Exception as e:
+            print(f"Error: {e}")
 
-    def get_chat_response(self, input):
+    async def aget_chat_response(self, input, schema=None):
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "user", "content": input},
-                ],
-                stream=False,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stop=None
-            )
-            return response.choices[0].message.content
+            return await self._achat_completion(input, schema)
         except ConnectionError:
             print("Error: Unable to connect to the server. Please check if the vllm service is running and the port is 8080.")
         except Exception as e:
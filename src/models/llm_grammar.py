@@ -0,0 +1,373 @@
+"""
+Schema-Constrained Decoding and JSON Streaming.
+Supports:
+- A character-level JSON automaton compiled from a pydantic model's JSON schema
+- A transformers logits processor that only lets local models emit schema-valid JSON and stops at the closing brace
+- Stopping criteria that end each row once its JSON answer closes
+"""
+
+import re
+import json
+import threading
+from collections import OrderedDict
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+from utils.text_scan import JSONScanner, answer_closed
+
+WHITESPACE = " \n\t\r"
+MAX_WHITESPACE = 16 # consecutive whitespace characters allowed between JSON tokens
+NUMBER_PREFIX = re.compile(r'-|-?(?:0|[1-9]\d*)(?:\.\d*)?(?:(?<=\d)[eE][+-]?\d*)?')
+NUMBER_COMPLETE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+INTEGER_PREFIX = re.compile(r'-|-?(?:0|[1-9]\d*)')
+INTEGER_COMPLETE = re.compile(r'-?(?:0|[1-9]\d*)')
+ANY = ("any",)
+
+def compile_schema(json_schema, defs=None, seen=()):
+    # Grammar nodes are nested tuples, so automaton states built from them are hashable
+    defs = json_schema.get("$defs", {}) if defs is None else defs
+    if "$ref" in json_schema:
+        name = json_schema["$ref"].split("/")[-1]
+        if name in seen:
+            return ANY
+        return compile_schema(defs.get(name, {}), defs, seen + (name,))
+    if "anyOf" in json_schema:
+        return ("union", tuple(compile_schema(option, defs, seen) for option in json_schema["anyOf"]))
+    if "enum" in json_schema:
+        return ("literal", tuple(json.dumps(value, ensure_ascii=False) for value in json_schema["enum"]))
+    if "const" in json_schema:
+        return ("literal", (json.dumps(json_schema["const"], ensure_ascii=False),))
+    schema_type = json_schema.get("type")
+    if schema_type == "object":
+        properties = json_schema.get("properties")
+        if not properties:
+            return ("any_object",)
+        # Keys are emitted in declaration order; optional fields can still be null
+        parts = ["{"]
+        for index, (key, value) in enumerate(properties.items()):
+            if index > 0:
+                parts.append(",")
+            parts += [json.dumps(key, ensure_ascii=False), ":", compile_schema(value, defs, seen)]
+        parts.append("}")
+        return ("object", tuple(parts))
+    if schema_type == "array":
+        return ("array", compile_schema(json_schema["items"], defs, seen) if "items" in json_schema else ANY)
+    if schema_type in ("string", "number", "integer", "boolean", "null"):
+        return (schema_type,)
+    return ANY
+
+def starts_with(node, char):
+    kind = node[0]
+    if kind == "union":
+        return any(starts_with(option, char) for option in node[1])
+    if kind == "literal":
+        return any(candidate[0] == char for candidate in node[1])
+    if kind in ("object", "any_object"):
+        return char == "{"
+    if kind == "array":
+        return char == "["
+    if kind == "string":
+        return char == '"'
+    if kind in ("number", "integer"):
+        return char == "-" or char.isdigit()
+    if kind == "boolean":
+        return char in "tf"
+    if kind == "null":
+        return char == "n"
+    return char in '{["tfn-' or char.isdigit()
+
+def open_value(node, char):
+    # Frame for a value of this node that starts with char, or None
+    if not starts_with(node, char):
+        return None
+    kind = node[0]
+    if kind == "union":
+        for option in node[1]:
+            if starts_with(option, char):
+                return open_value(option, char)
+        return None
+    if kind == "any":
+        if char == "{":
+            return ("any_object_frame", 0)
+        if char == "[":
+            return ("array_frame", ANY, 0)
+        if char == '"':
+            return ("string_frame", 0)
+        if char in "tf":
+            return ("literal_frame", ("true", "false"), 0)
+        if char == "n":
+            return ("literal_frame", ("null",), 0)
+        return ("number_frame", "", False)
+    if kind == "object":
+        return ("object_frame", node[1], 0)
+    if kind == "any_object":
+        return ("any_object_frame", 0)
+    if kind == "array":
+        return ("array_frame", node[1], 0)
+    if kind == "string":
+        return ("string_frame", 0)
+    if kind == "literal":
+        return ("literal_frame", node[1], 0)
+    if kind in ("number", "integer"):
+        return ("number_frame", "", kind == "integer")
+    if kind == "boolean":
+        return ("literal_frame", ("true", "false"), 0)
+    return ("literal_frame", ("null",), 0)
+
+def advance(state, char):
+    """Feed one character to an automaton state (frame stack, whitespace run); returns the next state or None."""
+    stack, whitespace = state
+    while True:
+        if not stack:
+            return None
+        frame = stack[-1]
+        kind = frame[0]
+        rest = stack[:-1]
+        if kind == "string_frame":
+            escape = frame[1]
+            if escape == 1:
+                if char == "u":
+                    return rest + (("string_frame", 5),), 0
+                if char in '"\\/bfnrt':
+                    return rest + (("string_frame", 0),), 0
+                return None
+            if escape > 1:
+                if char in "0123456789abcdefABCDEF":
+                    return rest + (("string_frame", escape - 1 if escape > 2 else 0),), 0
+                return None
+            if char == '"':
+                return rest, 0
+            if char == "\\":
+                return rest + (("string_frame", 1),), 0
+            if ord(char) < 0x20:
+                return None
+            return stack, 0
+        if kind == "literal_frame":
+            candidates, position = frame[1], frame[2]
+            candidates = tuple(candidate for candidate in candidates if len(candidate) > position and candidate[position] == char)
+            if not candidates:
+                return None
+            if any(len(candidate) == position + 1 for candidate in candidates):
+                return rest, 0
+            return rest + (("literal_frame", candidates, position + 1),), 0
+        if kind == "number_frame":
+            text, is_integer = frame[1], frame[2]
+            prefix, complete = (INTEGER_PREFIX, INTEGER_COMPLETE) if is_integer else (NUMBER_PREFIX, NUMBER_COMPLETE)
+            if prefix.fullmatch(text + char):
+                return rest + (("number_frame", text + char, is_integer),), 0
+            if not complete.fullmatch(text):
+                return None
+            # The number ended; the character belongs to the enclosing value
+            stack = rest
+            continue
+        if char in WHITESPACE:
+            if whitespace >= MAX_WHITESPACE:
+                return None
+            return stack, whitespace + 1
+        if kind == "value_frame":
+            opened = open_value(frame[1], char)
+            if opened is None:
+                return None
+            stack = rest + (opened,)
+            if opened[0] in ("object_frame", "any_object_frame", "array_frame"):
+                # The opening bracket is consumed here
+                if opened[0] == "object_frame":
+                    return rest + (("object_frame", opened[1], 1),), 0
+                return stack, 0
+            if opened[0] == "string_frame":
+                return stack, 0
+            continue
+        if kind == "object_frame":
+            parts, index = frame[1], frame[2]
+            part = parts[index]
+            child = ("literal_frame", (part,), 0) if isinstance(part, str) else ("value_frame", part)
+            # The closing brace replaces the object frame, so a finished object never stays on the stack
+            stack = rest + (child,) if index + 1 == len(parts) else rest + (("object_frame", parts, index + 1), child)
+            continue
+        if kind == "array_frame":
+            item, phase = frame[1], frame[2]
+            if phase == 1:
+                if char == ",":
+                    return rest + (("array_frame", item, 2),), 0
+                if char == "]":
+                    return rest, 0
+                return None
+            if phase == 0 and char == "]":
+                return rest, 0
+            stack = rest + (("array_frame", item, 1), ("value_frame", item))
+            continue
+        if kind == "any_object_frame":
+            phase = frame[1]
+            if phase in (0, 4) and char == '"':
+                return rest + (("any_object_frame", 1), ("string_frame", 0)), 0
+            if phase in (0, 3) and char == "}":
+                return rest, 0
+            if phase == 1 and char == ":":
+                return rest + (("any_object_frame", 2),), 0
+            if phase == 2:
+                stack = rest + (("any_object_frame", 3), ("value_frame", ANY))
+                continue
+            if phase == 3 and char == ",":
+                return rest + (("any_object_frame", 4),), 0
+            return None
+        return None
+
+def advance_text(state, text):
+    for char in text:
+        state = advance(state, char)
+        if state is None:
+            return None
+    return state
+
+class TokenTrie:
+    def __init__(self, token_texts: dict):
+        self.root = {}
+        for token_id, text in token_texts.items():
+            node = self.root
+            for char in text:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(token_id)
+
+    def walk(self, state, allowed: list):
+        # Depth-first over the trie, following only characters the automaton accepts
+        pending = [(self.root, state)]
+        while pending:
+            node, node_state = pending.pop()
+            for char, child in node.items():
+                if char is None:
+                    allowed.extend(child)
+                    continue
+                child_state = advance(node_state, char)
+                if child_state is not None:
+                    pending.append((child, child_state))
+        return allowed
+
+class TokenVocabulary:
+    """Decoded text of every token of a tokenizer, indexed for automaton-guided search."""
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, tokenizer):
+        special_ids = set(tokenizer.all_special_ids)
+        token_texts = {}
+        for token, token_id in tokenizer.get_vocab().items():
+            if token_id in special_ids:
+                continue
+            text = tokenizer.convert_tokens_to_string([token])
+            if token.startswith("▁") and not text.startswith(" "):
+                # SentencePiece drops the word-boundary space when a token is decoded on its own
+                text = " " + text
+            if text:
+                token_texts[token_id] = text
+        self.token_texts = token_texts
+        # Inside a string most tokens are plain text; only those that can end the string or start an escape need the trie
+        plain = re.compile(r'[^"\\\x00-\x1f]+')
+        self.plain_string_ids = torch.tensor([token_id for token_id, text in token_texts.items() if plain.fullmatch(text)], dtype=torch.long)
+        self.trie = TokenTrie(token_texts)
+        self.string_trie = TokenTrie({token_id: text for token_id, text in token_texts.items() if not plain.fullmatch(text)})
+
+    @classmethod
+    def get(cls, tokenizer):
+        with cls._cache_lock:
+            vocabulary = cls._cache.get(id(tokenizer))
+            if vocabulary is None:
+                vocabulary = cls(tokenizer)
+                cls._cache[id(tokenizer)] = vocabulary
+            return vocabulary
+
+class JSONLogitsProcessor(LogitsProcessor):
+    """Masks every token that would take the generated text out of the schema's JSON grammar; only EOS is allowed once the object closes."""
+
+    def __init__(self, tokenizer, schema_model, eos_token_ids: list, cache_size: int = 4096):
+        self.vocabulary = TokenVocabulary.get(tokenizer)
+        self.root = compile_schema(schema_model.model_json_schema())
+        self.eos_token_ids = [token_id for token_id in eos_token_ids if token_id is not None]
+        self.cache_size = cache_size
+        self._allowed_cache = OrderedDict()
+        self.prompt_length = None
+        self.states = []
+        self.consumed = []
+
+    def __allowed_ids(self, state):
+        allowed = self._allowed_cache.get(state)
+        if allowed is not None:
+            self._allowed_cache.move_to_end(state)
+            return allowed
+        stack = state[0]
+        if not stack:
+            allowed = torch.tensor(self.eos_token_ids, dtype=torch.long)
+        elif stack[-1] == ("string_frame", 0):
+            allowed = torch.cat([self.vocabulary.plain_string_ids, torch.tensor(self.vocabulary.string_trie.walk(state, []), dtype=torch.long)])
+        else:
+            allowed = torch.tensor(self.vocabulary.trie.walk(state, []), dtype=torch.long)
+        self._allowed_cache[state] = allowed
+        if len(self._allowed_cache) > self.cache_size:
+            self._allowed_cache.popitem(last=False)
+        return allowed
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            # The first call sees the prompt only
+            self.prompt_length = input_ids.shape[1]
+            # Start with the whitespace run exhausted, so the answer opens directly with the brace
+            self.states = [((("value_frame", self.root),), MAX_WHITESPACE)] * input_ids.shape[0]
+            self.consumed = [0] * input_ids.shape[0]
+        mask = torch.full_like(scores, float("-inf"))
+        for row in range(input_ids.shape[0]):
+            state = self.states[row]
+            generated = input_ids[row, self.prompt_length:].tolist()
+            for token_id in generated[self.consumed[row]:]:
+                if state is None:
+                    break
+                text = self.vocabulary.token_texts.get(token_id)
+                state = advance_text(state, text) if text is not None else None
+            self.states[row] = state
+            self.consumed[row] = len(generated)
+            if state is None:
+                # Finished (EOS/padding) or left the grammar: leave the row unconstrained
+                mask[row] = 0
+                continue
+            allowed = self.__allowed_ids(state)
+            allowed = allowed[allowed < scores.shape[1]]
+            if len(allowed) == 0:
+                mask[row] = 0
+                continue
+            mask[row, allowed.to(scores.device)] = 0
+        return scores + mask
+
+class JSONStoppingCriteria(StoppingCriteria):
+    """Stops each row as soon as its JSON answer closes; reports decoded chunks of a single response to on_chunk(request_id, delta, text)."""
+
+    def __init__(self, tokenizer, schema=None, on_chunk=None, request_id=None):
+        self.tokenizer = tokenizer
+        self.schema = schema
+        self.on_chunk = on_chunk
+        self.request_id = request_id
+        self.prompt_length = None
+        self.scanners = []
+        self.texts = []
+        self.done = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            # Called after each new token, so the first call sees exactly one generated token
+            self.prompt_length = input_ids.shape[1] - 1
+            self.scanners = [JSONScanner() for _ in range(input_ids.shape[0])]
+            self.texts = [""] * input_ids.shape[0]
+            self.done = [False] * input_ids.shape[0]
+        for row in range(input_ids.shape[0]):
+            if self.done[row]:
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            if text.endswith("\ufffd"):
+                # Wait for the rest of a multi-byte character
+                continue
+            delta = text[len(self.texts[row]):]
+            self.texts[row] = text
+            if not delta:
+                continue
+            if self.on_chunk is not None and input_ids.shape[0] == 1:
+                self.on_chunk(self.request_id, delta, text)
+            self.scanners[row].feed(delta)
+            self.done[row] = answer_closed(text, self.scanners[row], self.schema)
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
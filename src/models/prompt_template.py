@@ -112,6 +112,22 @@ summarize_instruction = PromptTemplate(
     template=SUMMARIZE_INSTRUCTION,
 )
 
+REPAIR_INSTRUCTION = """
+**Instruction**: The answer below was returned for an information extraction task, but it could not be used because of the listed errors. Fix only the format of the answer so that it is a valid JSON object matching the Output Schema. Keep the extracted information unchanged and DO NOT extract new information.
+
+**Output Schema**: {schema}
+
+**Answer**: {answer}
+
+**Errors**: {errors}
+
+Return the corrected answer as a JSON object without escape characters or line breaks, wrapped in triple backticks (```). Use standard double quotes ("") for JSON structure
+"""
+repair_instruction = PromptTemplate(
+    input_variables=["schema", "answer", "errors"],
+    template=REPAIR_INSTRUCTION,
+)
+
 
 
 
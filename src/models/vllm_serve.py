@@ -15,6 +15,8 @@ def main():
                         help='Tensor parallel size for the VLLM server.')
     parser.add_argument('--max-model-len', type=int, default=32768,
                         help='Maximum model length for the VLLM server.')
+    parser.add_argument('--guided-decoding-backend', type=str, default="outlines",
+                        help='Backend the VLLM server uses for response_format JSON schemas (structured_output).')
 
     # Parse command-line arguments
     args = parser.parse_args()
@@ -26,7 +28,7 @@ def main():
     if model_config['vllm_serve'] == False:
         warnings.warn("VLLM-deployed model will not be used for extraction. To enable VLLM, set vllm_serve to true in the configuration file.")
     model_name_or_path = model_config['model_name_or_path']
-    command = f"vllm serve {model_name_or_path} --tensor-parallel-size {args.tensor_parallel_size} --max-model-len {args.max_model_len} --enforce-eager --port 8000"
+    command = f"vllm serve {model_name_or_path} --tensor-parallel-size {args.tensor_parallel_size} --max-model-len {args.max_model_len} --guided-decoding-backend {args.guided_decoding_backend} --enforce-eager --port 8000"
     subprocess.run(command, shell=True)
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import asyncio
 from models import *
 from utils import *
 from .knowledge_base.case_repository import CaseRepositoryHandler
@@ -6,10 +7,10 @@ class InformationExtractor:
     def __init__(self, llm: BaseEngine):
         self.llm = llm
 
-    def extract_information(self, instruction="", text="", examples="", schema="", additional_info=""):
+    def extract_information(self, instruction="", text="", examples="", schema="", additional_info="", schema_model=None):
         examples = good_case_wrapper(examples)
         prompt = extract_instruction.format(instruction=instruction, examples=examples, text=text, additional_info=additional_info, schema=schema)
-        response = self.llm.get_chat_response(prompt)
+        response = self.llm.get_chat_response(prompt, schema=schema_model)
         response = extract_json_dict(response)
         return response
 
@@ -20,9 +21,55 @@ class InformationExtractor:
         response = extract_json_dict(response)
         return response
 
-    def summarize_answer(self, instruction="", answer_list="", schema="", additional_info=""):
+    def summarize_answer(self, instruction="", answer_list="", schema="", additional_info="", schema_model=None):
         prompt = summarize_instruction.format(instruction=instruction, answer_list=answer_list, schema=schema, additional_info=additional_info)
-        response = self.llm.get_chat_response(prompt)
+        response = self.llm.get_chat_response(prompt, schema=schema_model)
+        response = extract_json_dict(response)
+        return response
+
+    def repair_answer(self, schema="", answer="", errors="", schema_model=None):
+        prompt = repair_instruction.format(schema=schema, answer=answer, errors=errors)
+        response = self.llm.get_chat_response(prompt, schema=schema_model)
+        response = extract_json_dict(response)
+        return response
+
+    def extract_information_batch(self, instruction="", text_list=[], examples_list=[], schema="", additional_info="", schema_model=None):
+        prompts = [
+            extract_instruction.format(instruction=instruction, examples=good_case_wrapper(examples), text=text, additional_info=additional_info, schema=schema)
+            for text, examples in zip(text_list, examples_list)
+        ]
+        responses = self.llm.get_chat_responses(prompts, schema=schema_model)
+        return [extract_json_dict(response) for response in responses]
+
+    def extract_information_compatible_batch(self, task="", text_list=[], constraint=""):
+        instruction = instruction_mapper.get(task)
+        prompts = [extract_instruction_json.format(instruction=instruction, constraint=constraint, input=text) for text in text_list]
+        responses = self.llm.get_chat_responses(prompts)
+        return [extract_json_dict(response) for response in responses]
+
+    async def aextract_information(self, instruction="", text="", examples="", schema="", additional_info="", schema_model=None):
+        examples = good_case_wrapper(examples)
+        prompt = extract_instruction.format(instruction=instruction, examples=examples, text=text, additional_info=additional_info, schema=schema)
+        response = await self.llm.aget_chat_response(prompt, schema=schema_model)
+        response = extract_json_dict(response)
+        return response
+
+    async def aextract_information_compatible(self, task="", text="", constraint=""):
+        instruction = instruction_mapper.get(task)
+        prompt = extract_instruction_json.format(instruction=instruction, constraint=constraint, input=text)
+        response = await self.llm.aget_chat_response(prompt)
+        response = extract_json_dict(response)
+        return response
+
+    async def asummarize_answer(self, instruction="", answer_list="", schema="", additional_info="", schema_model=None):
+        prompt = summarize_instruction.format(instruction=instruction, answer_list=answer_list, schema=schema, additional_info=additional_info)
+        response = await self.llm.aget_chat_response(prompt, schema=schema_model)
+        response = extract_json_dict(response)
+        return response
+
+    async def arepair_answer(self, schema="", answer="", errors="", schema_model=None):
+        prompt = repair_instruction.format(schema=schema, answer=answer, errors=errors)
+        response = await self.llm.aget_chat_response(prompt, schema=schema_model)
         response = extract_json_dict(response)
         return response
 
@@ -95,15 +142,73 @@ class ExtractionAgent:
             # print("data.constraint", data.constraint)
         return data
 
+    def __extract_chunks(self, data: DataPoint, examples_list: list):
+        executor = config['agent']['executor']
+        compatible = self.llm.name == "OneKE"
+        # Only engines that batch natively gain from one get_chat_responses call; API engines would loop serially, so they use the thread pool
+        if executor == "batch" and self.llm.native_batching:
+            try:
+                if compatible:
+                    return self.module.extract_information_compatible_batch(task=data.task, text_list=data.chunk_text_list, constraint=data.constraint)
+                return self.module.extract_information_batch(instruction=data.instruction, text_list=data.chunk_text_list, examples_list=examples_list, schema=data.output_schema, additional_info=data.constraint, schema_model=data.schema_model)
+            except Exception as e:
+                print(f"Batch extraction failed, falling back to per-chunk extraction: {e}")
+
+        def extract_chunk(item):
+            chunk_text, examples = item
+            if compatible:
+                return self.module.extract_information_compatible(task=data.task, text=chunk_text, constraint=data.constraint)
+            return self.module.extract_information(instruction=data.instruction, text=chunk_text, schema=data.output_schema, examples=examples, additional_info=data.constraint, schema_model=data.schema_model)
+
+        max_workers = config['agent']['max_workers'] if executor != "serial" else 1
+        return parallel_map(extract_chunk, zip(data.chunk_text_list, examples_list), max_workers=max_workers, default={})
+
+    def __validate_results(self, data: DataPoint, result_list: list):
+        # Answers were already repaired locally while parsing; validate them and only re-ask for the ones still broken
+        if self.llm.name == "OneKE":
+            return result_list, []
+        validated = [validate_json(result, data.schema_model) for result in result_list]
+        result_list = [result for result, _ in validated]
+        failed = [(index, errors) for index, (_, errors) in enumerate(validated) if errors]
+        return result_list, failed
+
+    def __repair_results(self, data: DataPoint, result_list: list):
+        result_list, failed = self.__validate_results(data, result_list)
+        for _ in range(config['agent']['repair_retries']):
+            if not failed:
+                break
+            max_workers = config['agent']['max_workers'] if config['agent']['executor'] != "serial" else 1
+            answers = parallel_map(lambda item: self.module.repair_answer(schema=data.output_schema, answer=result_list[item[0]], errors="\n".join(item[1]), schema_model=data.schema_model), failed, max_workers=max_workers, default=None)
+            still_failed = []
+            for (index, errors), answer in zip(failed, answers):
+                answer, new_errors = validate_json(answer, data.schema_model)
+                if new_errors:
+                    still_failed.append((index, new_errors))
+                else:
+                    result_list[index] = answer
+            failed = still_failed
+        return result_list
+
+    async def __arepair_results(self, data: DataPoint, result_list: list):
+        result_list, failed = self.__validate_results(data, result_list)
+        for _ in range(config['agent']['repair_retries']):
+            if not failed:
+                break
+            answers = await gather_map((self.module.arepair_answer(schema=data.output_schema, answer=result_list[index], errors="\n".join(errors), schema_model=data.schema_model) for index, errors in failed), default=None)
+            still_failed = []
+            for (index, errors), answer in zip(failed, answers):
+                answer, new_errors = validate_json(answer, data.schema_model)
+                if new_errors:
+                    still_failed.append((index, new_errors))
+                else:
+                    result_list[index] = answer
+            failed = still_failed
+        return result_list
+
     def extract_information_direct(self, data: DataPoint):
         data = self.__get_constraint(data)
-        result_list = []
-        for chunk_text in data.chunk_text_list:
-            if self.llm.name != "OneKE":
-                extract_direct_result = self.module.extract_information(instruction=data.instruction, text=chunk_text, schema=data.output_schema, examples="", additional_info=data.constraint)
-            else:
-                extract_direct_result = self.module.extract_information_compatible(task=data.task, text=chunk_text, constraint=data.constraint)
-            result_list.append(extract_direct_result)
+        result_list = self.__extract_chunks(data, [""] * len(data.chunk_text_list))
+        result_list = self.__repair_results(data, result_list)
         function_name = current_function_name()
         data.set_result_list(result_list)
         data.update_trajectory(function_name, result_list)
@@ -111,24 +216,131 @@ class ExtractionAgent:
 
     def extract_information_with_case(self, data: DataPoint):
         data = self.__get_constraint(data)
-        result_list = []
-        for chunk_text in data.chunk_text_list:
-            examples = self.case_repo.query_good_case(data)
-            extract_case_result = self.module.extract_information(instruction=data.instruction, text=chunk_text, schema=data.output_schema, examples=examples, additional_info=data.constraint)
-            result_list.append(extract_case_result)
+        examples_list = self.case_repo.query_good_cases([data] * len(data.chunk_text_list))
+        result_list = self.__extract_chunks(data, examples_list)
+        result_list = self.__repair_results(data, result_list)
         function_name = current_function_name()
         data.set_result_list(result_list)
         data.update_trajectory(function_name, result_list)
         return data
 
+    def __group_answers(self, data: DataPoint, answer_list: list):
+        # Pack answers greedily into merge groups that fit the prompt budget, at least two per group
+        overhead = self.llm.count_tokens(summarize_instruction.format(instruction=data.instruction, answer_list="", schema=data.output_schema, additional_info=data.constraint))
+        budget = min(config['agent']['summarize_token_budget'], self.llm.context_length - self.llm.max_tokens) - overhead
+        groups = []
+        current_group, current_tokens = [], 0
+        for answer in answer_list:
+            tokens = self.llm.count_tokens(json.dumps(answer, ensure_ascii=False))
+            if len(current_group) >= 2 and current_tokens + tokens > budget:
+                groups.append(current_group)
+                current_group, current_tokens = [], 0
+            current_group.append(answer)
+            current_tokens += tokens
+        if current_group:
+            groups.append(current_group)
+        return groups
+
+    def __merge_group(self, data: DataPoint, group: list):
+        # A failed merge carries the group's answers forward unmerged instead of dropping them
+        if len(group) == 1:
+            return group
+        try:
+            return [self.module.summarize_answer(instruction=data.instruction, answer_list=group, schema=data.output_schema, additional_info=data.constraint, schema_model=data.schema_model)]
+        except Exception as e:
+            print(f"Error when merging {len(group)} answers, keeping them for the next level: {e}")
+            return group
+
+    async def __amerge_group(self, data: DataPoint, group: list):
+        if len(group) == 1:
+            return group
+        try:
+            return [await self.module.asummarize_answer(instruction=data.instruction, answer_list=group, schema=data.output_schema, additional_info=data.constraint, schema_model=data.schema_model)]
+        except Exception as e:
+            print(f"Error when merging {len(group)} answers, keeping them for the next level: {e}")
+            return group
+
+    def __next_level(self, answer_list: list, merged_groups: list):
+        next_list = [answer for merged in merged_groups for answer in merged]
+        if len(next_list) >= len(answer_list):
+            raise RuntimeError("Tree summarization made no progress: every merge call failed.")
+        return next_list
+
+    def __tree_summarize(self, data: DataPoint):
+        # Merge level by level; merges within a level are independent and run in parallel
+        answer_list = data.result_list
+        max_workers = config['agent']['max_workers'] if config['agent']['executor'] != "serial" else 1
+        while len(answer_list) > 1:
+            groups = self.__group_answers(data, answer_list)
+            answer_list = self.__next_level(answer_list, parallel_map(lambda group: self.__merge_group(data, group), groups, max_workers=max_workers))
+        return answer_list[0]
+
+    async def __atree_summarize(self, data: DataPoint):
+        answer_list = data.result_list
+        while len(answer_list) > 1:
+            groups = self.__group_answers(data, answer_list)
+            answer_list = self.__next_level(answer_list, await asyncio.gather(*(self.__amerge_group(data, group) for group in groups)))
+        return answer_list[0]
+
+    def __local_merge(self, data: DataPoint):
+        # Fixed-schema results only need union, dedup and type voting; None falls back to the LLM
+        if data.task == "Base" or config['agent']['summarize_with_llm']:
+            return None
+        return merge_results(data.task, data.result_list)
+
     def summarize_answer(self, data: DataPoint):
         if len(data.result_list) == 0:
             return data
         if len(data.result_list) == 1:
             data.set_pred(data.result_list[0])
             return data
-        summarized_result = self.module.summarize_answer(instruction=data.instruction, answer_list=data.result_list, schema=data.output_schema, additional_info=data.constraint)
+        merged_result = self.__local_merge(data)
+        if merged_result is not None:
+            summarized_result = merged_result
+        elif config['agent']['summarize_mode'] == "tree":
+            summarized_result = self.__tree_summarize(data)
+        else:
+            summarized_result = self.module.summarize_answer(instruction=data.instruction, answer_list=data.result_list, schema=data.output_schema, additional_info=data.constraint, schema_model=data.schema_model)
         funtion_name = current_function_name()
         data.set_pred(summarized_result)
         data.update_trajectory(funtion_name, summarized_result)
-        return data
\ No newline at end of file
+        return data
+
+    async def aextract_information_direct(self, data: DataPoint):
+        data = self.__get_constraint(data)
+        if self.llm.name != "OneKE":
+            tasks = [self.module.aextract_information(instruction=data.instruction, text=chunk_text, schema=data.output_schema, examples="", additional_info=data.constraint, schema_model=data.schema_model) for chunk_text in data.chunk_text_list]
+        else:
+            tasks = [self.module.aextract_information_compatible(task=data.task, text=chunk_text, constraint=data.constraint) for chunk_text in data.chunk_text_list]
+        result_list = await gather_map(tasks, default={})
+        result_list = await self.__arepair_results(data, result_list)
+        data.set_result_list(result_list)
+        data.update_trajectory("extract_information_direct", result_list)
+        return data
+
+    async def aextract_information_with_case(self, data: DataPoint):
+        data = self.__get_constraint(data)
+        examples_list = await asyncio.to_thread(self.case_repo.query_good_cases, [data] * len(data.chunk_text_list))
+        tasks = [self.module.aextract_information(instruction=data.instruction, text=chunk_text, schema=data.output_schema, examples=examples, additional_info=data.constraint, schema_model=data.schema_model) for chunk_text, examples in zip(data.chunk_text_list, examples_list)]
+        result_list = await gather_map(tasks, default={})
+        result_list = await self.__arepair_results(data, result_list)
+        data.set_result_list(result_list)
+        data.update_trajectory("extract_information_with_case", result_list)
+        return data
+
+    async def asummarize_answer(self, data: DataPoint):
+        if len(data.result_list) == 0:
+            return data
+        if len(data.result_list) == 1:
+            data.set_pred(data.result_list[0])
+            return data
+        merged_result = self.__local_merge(data)
+        if merged_result is not None:
+            summarized_result = merged_result
+        elif config['agent']['summarize_mode'] == "tree":
+            summarized_result = await self.__atree_summarize(data)
+        else:
+            summarized_result = await self.module.asummarize_answer(instruction=data.instruction, answer_list=data.result_list, schema=data.output_schema, additional_info=data.constraint, schema_model=data.schema_model)
+        data.set_pred(summarized_result)
+        data.update_trajectory("summarize_answer", summarized_result)
+        return data
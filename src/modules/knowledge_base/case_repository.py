@@ -1,11 +1,17 @@
 import json
 import os
+import queue
+import atexit
+import threading
 import torch
 import numpy as np
 from utils import *
 from sentence_transformers import SentenceTransformer
-from rapidfuzz import process
 from models import *
+from .embedding_store import EmbeddingStore, EmbeddingBuffer, text_hash
+from .vector_index import ExactIndex, HNSWIndex
+from .string_index import StringIndex
+from .case_store import CaseStore
 import copy
 
 import warnings
@@ -18,64 +24,122 @@ class CaseRepository:
         self._embedder = None
         self._corpus = None
         self._embedded_corpus = None
+        self._init_lock = threading.RLock()
+        # Serializes ranking against update_case, so the corpus, embeddings and both indexes are always the same size;
+        # query encoding stays outside it
+        self._update_lock = threading.RLock()
+        self._dirty_embeddings = set()
+        self._vector_indexes = {}
+        self._string_indexes = {}
+        self.case_store = CaseStore(os.path.join(os.path.dirname(__file__), "case_repository.json"), config['model']['case_log_compact_threshold'])
+        atexit.register(self.save_embeddings)
 
     @property
     def embedder(self):
-        if self._embedder is None:
-            try:
-                self._embedder = SentenceTransformer(docker_model_path)
-            except:
-                self._embedder = SentenceTransformer(config['model']['embedding_model'])
-            self._embedder.to(device)
+        with self._init_lock:
+            if self._embedder is None:
+                try:
+                    self._embedder = SentenceTransformer(docker_model_path)
+                except:
+                    self._embedder = SentenceTransformer(config['model']['embedding_model'])
+                self._embedder.to(device)
         return self._embedder
 
     @property
     def corpus(self):
-        if self._corpus is None:
-            self._corpus = self.load_corpus()
+        with self._init_lock:
+            if self._corpus is None:
+                self._corpus = self.load_corpus()
         return self._corpus
 
     @property
     def embedded_corpus(self):
-        if self._embedded_corpus is None:
-            self._embedded_corpus = self.embed_corpus()
+        with self._init_lock:
+            if self._embedded_corpus is None:
+                self._embedded_corpus = self.embed_corpus()
         return self._embedded_corpus
 
+    @property
+    def embedding_model_name(self):
+        return config['model']['embedding_model']
+
+    def embedding_store(self, task: TaskType, case_type: str):
+        directory = os.path.join(os.path.dirname(__file__), "case_embeddings")
+        return EmbeddingStore(directory, f"{task}_{case_type}", self.embedding_model_name, config['model']['embedding_dtype'])
+
+    def vector_index(self, task: TaskType, case_type: str):
+        if (task, case_type) not in self._vector_indexes:
+            self._vector_indexes[(task, case_type)] = self.build_vector_index(task, case_type)
+        return self._vector_indexes[(task, case_type)]
+
+    def build_vector_index(self, task: TaskType, case_type: str):
+        embeddings = self.embedded_corpus[task][case_type].view()
+        if config['model']['case_index'] == "hnsw":
+            try:
+                path = os.path.join(os.path.dirname(__file__), "case_embeddings", f"{task}_{case_type}.hnsw")
+                hashes = [text_hash(item['index']['embed_index']) for item in self.corpus[task][case_type]]
+                return HNSWIndex(path, embeddings.shape[1]).load_or_build(embeddings, hashes)
+            except ImportError as e:
+                print(f"{e} Falling back to exact case retrieval.")
+        return ExactIndex(lambda: self.embedded_corpus[task][case_type].view())
+
+    def string_index(self, task: TaskType, case_type: str):
+        if (task, case_type) not in self._string_indexes:
+            self._string_indexes[(task, case_type)] = StringIndex(item['index']['str_index'] for item in self.corpus[task][case_type])
+        return self._string_indexes[(task, case_type)]
+
+    def encode(self, texts):
+        # Normalized vectors, so cosine similarity is a plain dot product
+        return self.embedder.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+
     def load_corpus(self):
-        with open(os.path.join(os.path.dirname(__file__), "case_repository.json")) as file:
-            corpus = json.load(file)
-        return corpus
+        return self.case_store.load()
 
     def update_corpus(self):
+        # New cases are already in the append-only log; fold it into the JSON snapshot once it grows.
+        # Embeddings are persisted with the snapshot; logged cases missing from them are re-encoded on the next load
         try:
-            with open(os.path.join(os.path.dirname(__file__), "case_repository.json"), "w") as file:
-                json.dump(self.corpus, file, indent=2)
+            compacted = self.case_store.compact()
         except Exception as e:
             print(f"Error when updating corpus: {e}")
+            return
+        if compacted:
+            self.save_embeddings()
+
+    def save_embeddings(self):
+        with self._update_lock:
+            for task, case_type in self._dirty_embeddings:
+                hashes = [text_hash(item['index']['embed_index']) for item in self.corpus[task][case_type]]
+                try:
+                    self.embedding_store(task, case_type).save(self.embedded_corpus[task][case_type].view(), hashes)
+                    if (task, case_type) in self._vector_indexes:
+                        self._vector_indexes[(task, case_type)].save(hashes)
+                except Exception as e:
+                    print(f"Error when saving {case_type} case embeddings for {task} task: {e}")
+            self._dirty_embeddings.clear()
 
     def embed_corpus(self):
+        # Reuse persisted embeddings keyed by content hash, encoding only new or changed entries
         embedded_corpus = {}
+        dim = self.embedder.get_sentence_embedding_dimension()
         for key, content in self.corpus.items():
-            good_index = [item['index']['embed_index'] for item in content['good']]
-            encoded_good_index = self.embedder.encode(good_index, convert_to_tensor=True).to(device)
-            bad_index = [item['index']['embed_index'] for item in content['bad']]
-            encoded_bad_index = self.embedder.encode(bad_index, convert_to_tensor=True).to(device)
-            embedded_corpus[key] = {"good": encoded_good_index, "bad": encoded_bad_index}
+            embedded_corpus[key] = {}
+            for case_type in ("good", "bad"):
+                texts = [item['index']['embed_index'] for item in content[case_type]]
+                embedded_corpus[key][case_type] = EmbeddingBuffer(self.embedding_store(key, case_type).load(texts, self.encode, dim))
         return embedded_corpus
 
-    def get_similarity_scores(self, task: TaskType, embed_index="", str_index="", case_type="", top_k=2):
+    def __rank_candidates(self, task: TaskType, case_type: str, str_index: str, candidate_ids, embedding_similarity, top_k: int):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        # Embedding similarity match
-        encoded_embed_query = self.embedder.encode(embed_index, convert_to_tensor=True).to(device)
-        embedding_similarity_matrix = self.embedder.similarity(encoded_embed_query, self.embedded_corpus[task][case_type])
-        embedding_similarity_scores = embedding_similarity_matrix[0].to(device)
-
-        # String similarity match
-        str_match_corpus = [item['index']['str_index'] for item in self.corpus[task][case_type]]
-        str_similarity_results = process.extract(str_index, str_match_corpus, limit=len(str_match_corpus))
-        scores_dict = {match[0]: match[1] for match in str_similarity_results}
-        scores_in_order = [scores_dict[candidate] for candidate in str_match_corpus]
-        str_similarity_scores = torch.tensor(scores_in_order, dtype=torch.float32).to(device)
+        embedding_similarity_scores = torch.from_numpy(embedding_similarity).to(device)
+
+        # String similarity match, aligned to the candidate order
+        string_index = self.string_index(task, case_type)
+        if len(candidate_ids) == len(string_index):
+            str_similarity = string_index.score(str_index)
+        else:
+            str_similarity = string_index.score(str_index, candidate_ids)
+        str_similarity_scores = torch.from_numpy(str_similarity).to(device)
 
         # Normalize scores
         embedding_score_range = embedding_similarity_scores.max() - embedding_similarity_scores.min()
@@ -95,27 +159,86 @@ class CaseRepository:
 
         scores, indices = torch.topk(combined_scores, k=min(top_k, combined_scores.size(0)))
         original_scores, original_indices = torch.topk(original_combined_scores, k=min(top_k, original_combined_scores.size(0)))
+        # Map candidate positions back to corpus positions
+        candidate_ids = torch.from_numpy(np.asarray(candidate_ids, dtype=np.int64))
+        indices = candidate_ids[indices.cpu()]
+        original_indices = candidate_ids[original_indices.cpu()]
         return scores, indices, original_scores, original_indices
 
-    def query_case(self, task: TaskType, embed_index="", str_index="", case_type="", top_k=2) -> list:
-        _, indices, _, _ = self.get_similarity_scores(task, embed_index, str_index, case_type, top_k)
-        top_matches = [self.corpus[task][case_type][idx]["content"] for idx in indices]
-        return top_matches
+    def __encode_queries(self, embed_indexes: list, cache: dict):
+        # Encode each distinct query text missing from the request cache once, in a single batch, outside the update lock
+        cached_embeddings = cache.setdefault("embeddings", {})
+        missing_texts = list(dict.fromkeys(embed_index for embed_index in embed_indexes if text_hash(embed_index) not in cached_embeddings))
+        if missing_texts:
+            for text, embedding in zip(missing_texts, self.encode(missing_texts)):
+                cached_embeddings[text_hash(text)] = embedding
+
+    def get_similarity_scores_batch(self, task: TaskType, embed_indexes: list, str_indexes: list, case_type="", top_k=2, cache: dict = None):
+        # cache is request-scoped: query embeddings by text hash, ranked results by query and corpus size
+        cache = {} if cache is None else cache
+        self.__encode_queries(embed_indexes, cache)
+        cached_embeddings = cache["embeddings"]
+        cached_results = cache.setdefault("results", {})
+        with self._update_lock:
+            corpus_size = len(self.corpus[task][case_type])
+            embed_hashes = [text_hash(embed_index) for embed_index in embed_indexes]
+            keys = [(task, case_type, corpus_size, embed_hash, text_hash(str_index), top_k) for embed_hash, str_index in zip(embed_hashes, str_indexes)]
+            pending = [i for i, key in enumerate(keys) if key not in cached_results]
+            if pending:
+                query_hashes = list(dict.fromkeys(embed_hashes[i] for i in pending))
+                rows = {query_hash: row for row, query_hash in enumerate(query_hashes)}
+                # Embedding similarity match: the exact index scores every case, an ANN index only the nearest candidates
+                candidates = self.vector_index(task, case_type).search_batch(np.stack([cached_embeddings[query_hash] for query_hash in query_hashes]), max(top_k, config['model']['case_index_candidates']))
+                for i in pending:
+                    cached_results[keys[i]] = self.__rank_candidates(task, case_type, str_indexes[i], *candidates[rows[embed_hashes[i]]], top_k)
+            return [cached_results[key] for key in keys]
+
+    def get_similarity_scores(self, task: TaskType, embed_index="", str_index="", case_type="", top_k=2, cache: dict = None):
+        return self.get_similarity_scores_batch(task, [embed_index], [str_index], case_type, top_k, cache)[0]
+
+    def query_cases(self, task: TaskType, embed_indexes: list, str_indexes: list, case_type="", top_k=2, cache: dict = None) -> list:
+        cache = {} if cache is None else cache
+        self.__encode_queries(embed_indexes, cache)
+        # Ranking and the content reads see the same corpus
+        with self._update_lock:
+            results = self.get_similarity_scores_batch(task, embed_indexes, str_indexes, case_type, top_k, cache)
+            return [[self.corpus[task][case_type][idx]["content"] for idx in indices] for _, indices, _, _ in results]
+
+    def query_case(self, task: TaskType, embed_index="", str_index="", case_type="", top_k=2, cache: dict = None) -> list:
+        return self.query_cases(task, [embed_index], [str_index], case_type, top_k, cache)[0]
 
     def update_case(self, task: TaskType, embed_index="", str_index="", content="" ,case_type=""):
-        self.corpus[task][case_type].append({"index": {"embed_index": embed_index, "str_index": str_index}, "content": content})
-        self.embedded_corpus[task][case_type] = torch.cat([self.embedded_corpus[task][case_type], self.embedder.encode([embed_index], convert_to_tensor=True).to(device)], dim=0)
+        case = {"index": {"embed_index": embed_index, "str_index": str_index}, "content": content}
+        try:
+            self.case_store.append(task, case_type, case)
+        except Exception as e:
+            print(f"Error when saving {case_type} case for {task} task: {e}")
+        # Encode outside the lock; the in-memory corpus and its indexes then grow together
+        encoded_embed_index = self.encode([embed_index])
+        with self._update_lock:
+            self.corpus[task][case_type].append(case)
+            self.embedded_corpus[task][case_type].append(encoded_embed_index)
+            if (task, case_type) in self._vector_indexes:
+                self._vector_indexes[(task, case_type)].add(encoded_embed_index)
+            if (task, case_type) in self._string_indexes:
+                self._string_indexes[(task, case_type)].add(str_index)
+            self._dirty_embeddings.add((task, case_type))
         print(f"A {case_type} case updated for {task} task.")
 
 class CaseRepositoryHandler:
     def __init__(self, llm: BaseEngine):
         self._repository = None
+        self._repository_lock = threading.Lock()
         self.llm = llm
+        self._update_queue = None
+        self._update_worker = None
+        self._update_lock = threading.Lock()
 
     @property
     def repository(self):
-        if self._repository is None:
-            self._repository = CaseRepository()
+        with self._repository_lock:
+            if self._repository is None:
+                self._repository = CaseRepository()
         return self._repository
 
     def __get_good_case_analysis(self, instruction="", text="", result="", additional_info=""):
@@ -124,9 +247,9 @@ class CaseRepositoryHandler:
         )
         for _ in range(3):
             response = self.llm.get_chat_response(prompt)
-            response = extract_json_dict(response)
-            if not isinstance(response, dict):
-                return response
+            # Prose that quotes the answer is kept; only a bare JSON answer is asked again
+            if not is_bare_json(response):
+                return response.strip()
         return None
 
     def __get_bad_case_reflection(self, instruction="", text="", original_answer="", correct_answer="", additional_info=""):
@@ -135,9 +258,9 @@ class CaseRepositoryHandler:
         )
         for _ in range(3):
             response = self.llm.get_chat_response(prompt)
-            response = extract_json_dict(response)
-            if not isinstance(response, dict):
-                return response
+            # Prose that quotes the answer is kept; only a bare JSON answer is asked again
+            if not is_bare_json(response):
+                return response.strip()
         return None
 
     def __get_index(self, data: DataPoint, case_type: str):
@@ -157,18 +280,34 @@ class CaseRepositoryHandler:
 
     def query_good_case(self, data: DataPoint):
         embed_index, str_index = self.__get_index(data, "good")
-        return self.repository.query_case(task=data.task, embed_index=embed_index, str_index=str_index, case_type="good")
+        return self.repository.query_case(task=data.task, embed_index=embed_index, str_index=str_index, case_type="good", cache=data.retrieval_cache)
+
+    def query_good_cases(self, data_list: list):
+        # One encode batch and one similarity pass per task; examples come back in input order
+        examples_list = [None] * len(data_list)
+        positions_by_task = {}
+        for position, data in enumerate(data_list):
+            positions_by_task.setdefault(data.task, []).append(position)
+        for task, positions in positions_by_task.items():
+            indexes = [self.__get_index(data_list[position], "good") for position in positions]
+            # Share one request cache when all queries come from the same DataPoint
+            same_data = all(data_list[position] is data_list[positions[0]] for position in positions)
+            cache = data_list[positions[0]].retrieval_cache if same_data else None
+            task_examples = self.repository.query_cases(task=task, embed_indexes=[index[0] for index in indexes], str_indexes=[index[1] for index in indexes], case_type="good", cache=cache)
+            for position, examples in zip(positions, task_examples):
+                examples_list[position] = examples
+        return examples_list
 
     def query_bad_case(self, data: DataPoint):
         embed_index, str_index = self.__get_index(data, "bad")
-        return self.repository.query_case(task=data.task, embed_index=embed_index, str_index=str_index, case_type="bad")
+        return self.repository.query_case(task=data.task, embed_index=embed_index, str_index=str_index, case_type="bad", cache=data.retrieval_cache)
 
     def update_good_case(self, data: DataPoint):
         if data.truth == "" :
             print("No truth value provided.")
             return
         embed_index, str_index = self.__get_index(data, "good")
-        _, _, original_scores, _ = self.repository.get_similarity_scores(data.task, embed_index, str_index, "good", 1)
+        _, _, original_scores, _ = self.repository.get_similarity_scores(data.task, embed_index, str_index, "good", 1, cache=data.retrieval_cache)
         original_scores = original_scores.tolist()
         if original_scores[0] >= 0.9:
             print("The similar good case is already in the corpus. Similarity Score: ", original_scores[0])
@@ -191,7 +330,7 @@ class CaseRepositoryHandler:
         if normalize_obj(data.pred) == normalize_obj(data.truth):
             return
         embed_index, str_index = self.__get_index(data, "bad")
-        _, _, original_scores, _ = self.repository.get_similarity_scores(data.task, embed_index, str_index, "bad", 1)
+        _, _, original_scores, _ = self.repository.get_similarity_scores(data.task, embed_index, str_index, "bad", 1, cache=data.retrieval_cache)
         original_scores = original_scores.tolist()
         if original_scores[0] >= 0.9:
             print("The similar bad case is already in the corpus. Similarity Score: ", original_scores[0])
@@ -208,7 +347,59 @@ class CaseRepositoryHandler:
             content =  f"{wrapped_text}\n\n{data.constraint}\n\n{wrapper_original_answer}\n\n{wrapped_bad_case_reflection}\n\n{wrapper_correct_answer}"
         self.repository.update_case(data.task, embed_index, str_index, content, "bad")
 
+    def __learn_case(self, data: DataPoint):
+        # Good-case analysis and bad-case reflection are independent LLM calls. They run on plain threads:
+        # concurrent.futures refuses new work once the interpreter is shutting down, which is when flush runs at exit
+        def learn(update):
+            try:
+                update(data)
+            except Exception as e:
+                print(f"Error when updating case: {e}")
+
+        workers = [threading.Thread(target=learn, args=(update,)) for update in (self.update_good_case, self.update_bad_case)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
     def update_case(self, data: DataPoint):
-        self.update_good_case(data)
-        self.update_bad_case(data)
-        self.repository.update_corpus()
\ No newline at end of file
+        self.__learn_case(data)
+        self.repository.update_corpus()
+
+    def submit_update(self, data: DataPoint):
+        # Queue the item for background learning; blocks only while the backlog is full
+        with self._update_lock:
+            if self._update_worker is None or not self._update_worker.is_alive():
+                if self._update_queue is None:
+                    self._update_queue = queue.Queue(maxsize=config['agent']['case_update_backlog'])
+                    atexit.register(self.flush)
+                self._update_worker = threading.Thread(target=self.__learn_loop, daemon=True)
+                self._update_worker.start()
+        self._update_queue.put(copy.deepcopy(data))
+
+    def __learn_loop(self):
+        while True:
+            batch = [self._update_queue.get()]
+            while len(batch) < config['agent']['case_update_batch_size']:
+                try:
+                    batch.append(self._update_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for data in batch:
+                    self.__learn_case(data)
+                # Persist once per batch
+                self.repository.update_corpus()
+            except Exception as e:
+                print(f"Error when learning cases in background: {e}")
+            finally:
+                for _ in batch:
+                    self._update_queue.task_done()
+
+    def flush(self):
+        # Wait until every queued case update has been learned and persisted
+        if self._update_queue is not None:
+            self._update_queue.join()
+        # Persist embeddings learned since the last compaction once, instead of after every update
+        if self._repository is not None:
+            self._repository.save_embeddings()
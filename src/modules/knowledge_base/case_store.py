@@ -0,0 +1,68 @@
+"""
+Append-only Case Store.
+Supports:
+- Writing each new case as one line of a JSONL log beside case_repository.json
+- Inter-process file locking, so concurrent pipelines never lose cases
+- Periodic compaction of the log into the JSON snapshot
+"""
+
+import os
+import json
+from filelock import FileLock
+
+class CaseStore:
+    def __init__(self, json_path: str, compact_threshold: int = 200):
+        self.json_path = json_path
+        self.log_path = f"{os.path.splitext(json_path)[0]}.log.jsonl"
+        self.compact_threshold = compact_threshold
+        self.lock = FileLock(f"{json_path}.lock")
+
+    def __read(self):
+        with open(self.json_path) as file:
+            corpus = json.load(file)
+        if not os.path.exists(self.log_path):
+            return corpus, 0
+        count = 0
+        with open(self.log_path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash is skipped
+                    continue
+                corpus.setdefault(record["task"], {"good": [], "bad": []}).setdefault(record["case_type"], []).append(record["case"])
+                count += 1
+        return corpus, count
+
+    def load(self):
+        with self.lock:
+            corpus, _ = self.__read()
+        return corpus
+
+    def append(self, task: str, case_type: str, case: dict):
+        line = json.dumps({"task": task, "case_type": case_type, "case": case}, ensure_ascii=False)
+        with self.lock:
+            with open(self.log_path, "a") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def __count_log(self):
+        if not os.path.exists(self.log_path):
+            return 0
+        with open(self.log_path, "rb") as file:
+            return sum(1 for _ in file)
+
+    def compact(self, force: bool = False):
+        # Returns True when the log was folded into the snapshot; below the threshold only the (bounded) log is read
+        with self.lock:
+            count = self.__count_log()
+            if count == 0 or (count < self.compact_threshold and not force):
+                return False
+            corpus, _ = self.__read()
+            tmp_path = f"{self.json_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(corpus, file, indent=2)
+            os.replace(tmp_path, self.json_path)
+            open(self.log_path, "w").close()
+        return True
@@ -0,0 +1,108 @@
+"""
+Persisted Embedding Store.
+Supports:
+- Content-hashed embeddings of case index texts, saved beside case_repository.json
+- Memory-mapped loading, shared by worker processes without copying
+- Incremental encoding of new or changed entries only
+- Growable embedding buffers with amortized O(1) appends
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+def text_hash(text: str):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class EmbeddingBuffer:
+    def __init__(self, data):
+        # Starts on the (possibly memory-mapped, read-only) loaded matrix and only copies on first growth
+        self._data = data
+        self.size = len(data)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def dim(self):
+        return self._data.shape[1]
+
+    def view(self):
+        # Valid prefix only; earlier views stay valid when the buffer is reallocated
+        return self._data[:self.size]
+
+    def append(self, vectors):
+        vectors = np.asarray(vectors, dtype=self._data.dtype).reshape(-1, self.dim)
+        required = self.size + len(vectors)
+        if required > len(self._data) or not self._data.flags.writeable:
+            capacity = max(2 * len(self._data), required, 16)
+            data = np.empty((capacity, self.dim), dtype=self._data.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:required] = vectors
+        self.size = required
+
+class EmbeddingStore:
+    def __init__(self, directory: str, name: str, model_name: str, dtype: str = "float32"):
+        self.directory = directory
+        self.matrix_path = os.path.join(directory, f"{name}.npy")
+        self.meta_path = os.path.join(directory, f"{name}.json")
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+
+    def __read_meta(self):
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.matrix_path)):
+            return None
+        try:
+            with open(self.meta_path) as file:
+                meta = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return None
+        # Embeddings from another model or precision cannot be reused
+        if meta.get("model") != self.model_name or meta.get("dtype") != self.dtype.name:
+            return None
+        return meta
+
+    def load(self, texts: list, encode, dim: int):
+        hashes = [text_hash(text) for text in texts]
+        meta = self.__read_meta()
+        if meta is not None and meta["hashes"] == hashes:
+            matrix = np.load(self.matrix_path, mmap_mode="r")
+            if matrix.shape == (len(hashes), dim):
+                return matrix
+            meta = None
+
+        old_rows = {}
+        old_matrix = None
+        if meta is not None:
+            old_matrix = np.load(self.matrix_path, mmap_mode="r")
+            if old_matrix.shape == (len(meta["hashes"]), dim):
+                old_rows = {h: row for row, h in enumerate(meta["hashes"])}
+        missing = [i for i, h in enumerate(hashes) if h not in old_rows]
+
+        matrix = np.empty((len(texts), dim), dtype=self.dtype)
+        for i, h in enumerate(hashes):
+            if h in old_rows:
+                matrix[i] = old_matrix[old_rows[h]]
+        if missing:
+            matrix[missing] = encode([texts[i] for i in missing])
+        del old_matrix
+        self.save(matrix, hashes)
+        return np.load(self.matrix_path, mmap_mode="r")
+
+    def save(self, matrix, hashes: list):
+        # Write to temporary files first so concurrent readers never see a partial matrix
+        os.makedirs(self.directory, exist_ok=True)
+        pid = os.getpid()
+        tmp_matrix_path = f"{self.matrix_path}.{pid}.tmp.npy"
+        tmp_meta_path = f"{self.meta_path}.{pid}.tmp"
+        np.save(tmp_matrix_path, np.asarray(matrix, dtype=self.dtype))
+        with open(tmp_meta_path, "w") as file:
+            json.dump({"model": self.model_name, "dtype": self.dtype.name, "hashes": hashes}, file)
+        os.replace(tmp_matrix_path, self.matrix_path)
+        os.replace(tmp_meta_path, self.meta_path)
@@ -0,0 +1,52 @@
+"""
+String Index for Case Retrieval.
+Supports:
+- Fuzzy string scores of a query against all str_index fields, aligned to corpus order
+- Vectorized scoring with rapidfuzz.process.cdist
+- Incremental inserts from update_case
+- Memoized score vectors for repeated queries (e.g. the same constraint for every sentence of a dataset)
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+from rapidfuzz import process, fuzz
+
+class StringIndex:
+    def __init__(self, texts: list, cache_size: int = 256):
+        self.texts = list(texts)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text: str):
+        with self._lock:
+            self.texts.append(text)
+            # Extend cached vectors with the new entry instead of dropping them
+            for query in list(self._cache):
+                self._cache[query] = np.append(self._cache[query], np.float32(fuzz.WRatio(query, text)))
+
+    def score(self, query: str, ids=None):
+        # Same scorer as process.extract (WRatio, no processor), returned as a float32 vector in corpus order
+        with self._lock:
+            scores = self._cache.get(query)
+            if scores is not None:
+                self._cache.move_to_end(query)
+            texts = list(self.texts)
+        if scores is None:
+            if len(texts) == 0:
+                scores = np.zeros(0, dtype=np.float32)
+            else:
+                scores = process.cdist([query], texts, scorer=fuzz.WRatio, dtype=np.float32)[0]
+            with self._lock:
+                # Only cache a vector that still covers the whole corpus
+                if len(scores) == len(self.texts):
+                    self._cache[query] = scores
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        if ids is not None:
+            return scores[np.asarray(ids, dtype=np.int64)]
+        return scores
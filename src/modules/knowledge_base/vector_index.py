@@ -0,0 +1,113 @@
+"""
+Vector Indexes for Case Retrieval.
+Supports:
+- Exact inner-product search over the live embedding matrix (numpy)
+- Approximate HNSW search (optional, requires hnswlib) with incremental inserts and persistence
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+def hashes_digest(hashes: list):
+    return hashlib.sha1("".join(hashes).encode("utf-8")).hexdigest()
+
+class ExactIndex:
+    def __init__(self, get_embeddings):
+        # Reads the repository's embedding matrix on every query, so inserts need no extra work
+        self.get_embeddings = get_embeddings
+
+    def __len__(self):
+        return len(self.get_embeddings())
+
+    def add(self, vectors):
+        pass
+
+    def search(self, query, k: int):
+        return self.search_batch(np.asarray(query).reshape(1, -1), k)[0]
+
+    def search_batch(self, queries, k: int):
+        # One matrix multiply for all queries; exact search scores the whole corpus and the caller re-ranks
+        embeddings = self.get_embeddings()
+        scores = np.asarray(queries.astype(embeddings.dtype) @ embeddings.T, dtype=np.float32)
+        candidate_ids = np.arange(scores.shape[1])
+        return [(candidate_ids, row) for row in scores]
+
+    def save(self, hashes: list):
+        pass
+
+class HNSWIndex:
+    def __init__(self, path: str, dim: int, M: int = 16, ef_construction: int = 200, ef_search: int = 128):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the HNSW case index. Install it with `pip install hnswlib`.")
+        self.path = path
+        self.meta_path = f"{path}.json"
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = None
+
+    def __len__(self):
+        return self.index.get_current_count() if self.index is not None else 0
+
+    def __new_index(self, capacity: int):
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=max(capacity, 16), ef_construction=self.ef_construction, M=self.M)
+        index.set_ef(self.ef_search)
+        return index
+
+    def load_or_build(self, embeddings, hashes: list):
+        digest = hashes_digest(hashes)
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path) as file:
+                    meta = json.load(file)
+                if meta.get("digest") == digest and meta.get("dim") == self.dim:
+                    index = hnswlib.Index(space="ip", dim=self.dim)
+                    index.load_index(self.path, max_elements=max(2 * len(hashes), 16))
+                    index.set_ef(self.ef_search)
+                    self.index = index
+                    return self
+            except Exception as e:
+                print(f"Error when loading HNSW index {self.path}, rebuilding: {e}")
+        self.index = self.__new_index(2 * len(hashes))
+        if len(hashes) > 0:
+            self.index.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(len(hashes)))
+        self.save(hashes)
+        return self
+
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        count = self.index.get_current_count()
+        if count + len(vectors) > self.index.get_max_elements():
+            self.index.resize_index(2 * (count + len(vectors)))
+        self.index.add_items(vectors, np.arange(count, count + len(vectors)))
+
+    def search(self, query, k: int):
+        return self.search_batch(query, k)[0]
+
+    def search_batch(self, queries, k: int):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, self.index.get_current_count())
+        if k == 0:
+            return [(np.arange(0), np.zeros(0, dtype=np.float32)) for _ in queries]
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(queries, k=k)
+        # hnswlib reports inner-product distance as 1 - dot
+        return [(row_labels.astype(np.int64), (1.0 - row_distances).astype(np.float32)) for row_labels, row_distances in zip(labels, distances)]
+
+    def save(self, hashes: list):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        self.index.save_index(tmp_path)
+        os.replace(tmp_path, self.path)
+        with open(f"{self.meta_path}.{os.getpid()}.tmp", "w") as file:
+            json.dump({"digest": hashes_digest(hashes), "dim": self.dim}, file)
+        os.replace(f"{self.meta_path}.{os.getpid()}.tmp", self.meta_path)
@@ -6,11 +6,11 @@ class ReflectionGenerator:
     def __init__(self, llm: BaseEngine):
         self.llm = llm
 
-    def get_reflection(self, instruction="", examples="", text="",schema="", result=""):
+    def get_reflection(self, instruction="", examples="", text="",schema="", result="", schema_model=None):
         result = json.dumps(result)
         examples = bad_case_wrapper(examples)
         prompt = reflect_instruction.format(instruction=instruction, examples=examples, text=text, schema=schema, result=result)
-        response = self.llm.get_chat_response(prompt)
+        response = self.llm.get_chat_response(prompt, schema=schema_model)
         response = extract_json_dict(response)
         return response
 
@@ -61,12 +61,21 @@ class ReflectionAgent:
             return data
         reflect_index = self.__self_consistance_check(data)
         reflected_result_list = data.result_list
-        for idx in reflect_index:
+
+        # The bad-case query depends only on the DataPoint, so retrieve once for every chunk
+        examples = json.dumps(self.case_repo.query_bad_case(data)) if reflect_index else ""
+
+        def reflect_chunk(idx):
             text = data.chunk_text_list[idx]
             result = data.result_list[idx]
-            examples = json.dumps(self.case_repo.query_bad_case(data))
-            reflected_res = self.module.get_reflection(instruction=data.instruction, examples=examples, text=text, schema=data.output_schema, result=result)
-            reflected_result_list[idx] = reflected_res
+            return self.module.get_reflection(instruction=data.instruction, examples=examples, text=text, schema=data.output_schema, result=result, schema_model=data.schema_model)
+
+        max_workers = config['agent']['max_workers'] if config['agent']['executor'] != "serial" else 1
+        reflected_results = parallel_map(reflect_chunk, reflect_index, max_workers=max_workers)
+        for idx, reflected_res in zip(reflect_index, reflected_results):
+            # Keep the self-consistent result when reflection on a chunk fails
+            if reflected_res is not None:
+                reflected_result_list[idx] = reflected_res
         data.set_result_list(reflected_result_list)
         function_name = current_function_name()
         data.update_trajectory(function_name, data.result_list)
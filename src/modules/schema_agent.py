@@ -1,3 +1,5 @@
+import threading
+from concurrent.futures import Future
 from models import *
 from utils import *
 from .knowledge_base import schema_repository
@@ -32,7 +34,7 @@ class SchemaAnalyzer:
     def get_text_analysis(self, text: str):
         output_schema = self.serialize_schema(schema_repository.TextDescription)
         prompt = text_analysis_instruction.format(examples="", text=text, schema=output_schema)
-        response = self.llm.get_chat_response(prompt)
+        response = self.llm.get_chat_response(prompt, schema=schema_repository.TextDescription)
         response = extract_json_dict(response)
         response = self.redefine_text(response)
         return response
@@ -43,7 +45,7 @@ class SchemaAnalyzer:
         response = extract_json_dict(response)
         code = response
         print(f"Deduced Schema in Json: \n{response}\n\n")
-        return code, response
+        return code, response, None
 
     def get_deduced_schema_code(self, instruction: str, text: str, distilled_text: str):
         prompt = deduced_schema_code_instruction.format(examples=example_wrapper(code_schema_examples), instruction=instruction, distilled_text=distilled_text, text=text)
@@ -59,8 +61,7 @@ class SchemaAnalyzer:
                     index = code_block.find("class")
                     code = code_block[index:]
                     print(f"Deduced Schema in Code: \n{code}\n\n")
-                    schema = self.serialize_schema(schema)
-                    return code, schema
+                    return code, self.serialize_schema(schema), schema
             except Exception as e:
                 print(e)
                 return self.get_deduced_schema_json(instruction, text, distilled_text)
@@ -72,12 +73,36 @@ class SchemaAgent:
         self.module = SchemaAnalyzer(llm = llm)
         self.schema_repo = schema_repository
         self.methods = ["get_default_schema", "get_retrieved_schema", "get_deduced_schema"]
+        self._shared_lock = threading.Lock()
+
+    def __run_shared(self, data: DataPoint, key, func):
+        # Schema work keyed the same by documents of one shared batch (data.shared_work) runs only once
+        with self._shared_lock:
+            if data.shared_work is None:
+                future, owner = None, False
+            else:
+                future = data.shared_work.get(key)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    data.shared_work[key] = future
+        if future is None:
+            return func()
+        if owner:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
 
     def __preprocess_text(self, data: DataPoint):
+        # Size chunks for this engine: measure the extraction prompt without text, schema or examples
+        prompt_overhead = self.llm.count_tokens(extract_instruction.format(instruction=data.instruction, examples="", text="", additional_info=data.constraint, schema=""))
+        token_limit = get_chunk_token_limit(self.llm, prompt_overhead)
         if data.use_file:
-            data.chunk_text_list = chunk_file(data.file_path)
+            data.chunk_text_list = chunk_file(data.file_path, token_limit=token_limit, count_tokens=self.llm.count_tokens_batch)
         else:
-            data.chunk_text_list = chunk_str(data.text)
+            data.chunk_text_list = chunk_str(data.text, token_limit=token_limit, count_tokens=self.llm.count_tokens_batch)
         if data.task == "NER":
             data.print_schema = """
 class Entity(BaseModel):
@@ -136,6 +161,7 @@ class TripleList(BaseModel):
             schema = self.module.serialize_schema(schema_class)
             default_schema = config['agent']['default_schema']
             data.set_schema(f"{default_schema}\n{schema}")
+            data.schema_model = schema_class
             function_name = current_function_name()
             data.update_trajectory(function_name, schema)
         else:
@@ -150,11 +176,13 @@ class TripleList(BaseModel):
             prefix = "Below is a portion of the text to be extracted. "
             analysed_text = f"{prefix}\n{target_text}"
         distilled_text = self.module.redefine_text(analysed_text)
-        code, deduced_schema = self.module.get_deduced_schema_code(data.instruction, target_text, distilled_text)
+        # With a shared batch, documents with the same task, instruction and output schema reuse the schema deduced from the first one
+        code, deduced_schema, schema_class = self.__run_shared(data, ("deduced", data.task, data.instruction, data.output_schema), lambda: self.module.get_deduced_schema_code(data.instruction, target_text, distilled_text))
         data.print_schema = code
         data.set_distilled_text(distilled_text)
         default_schema = config['agent']['default_schema']
         data.set_schema(f"{default_schema}\n{deduced_schema}")
+        data.schema_model = schema_class
         function_name = current_function_name()
         data.update_trajectory(function_name, deduced_schema)
         return data
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Literal
 from models import *
 from utils import *
@@ -5,8 +6,16 @@ from modules import *
 from construct import *
 
 class Pipeline:
-    def __init__(self, llm: BaseEngine):
-        self.llm = llm
+    def __init__(self, llm: BaseEngine, coalesce_requests: bool = True, structured_output: bool = None, stream: bool = None, on_chunk=None):
+        # Constrain answers to the target schema (response_format or constrained decoding) on engines that support it
+        if structured_output is not None:
+            llm.set_structured_output(structured_output)
+        # Stream answers and cancel each request once its JSON object closes; on_chunk(request_id, delta, text) sees each chunk
+        if stream is not None:
+            llm.set_streaming(stream, on_chunk)
+        # Engines that batch natively get concurrent single-prompt calls merged into one forward pass
+        if coalesce_requests and llm.native_batching and not isinstance(llm, BatchedEngine):
+            llm = BatchedEngine(llm)
         self.llm = llm
         self.case_repo = CaseRepositoryHandler(llm = llm)
         self.schema_agent = SchemaAgent(llm = llm)
@@ -55,32 +64,14 @@ class Pipeline:
             data.output_schema = "TripleList"
         return data
 
-    # main entry
-    def get_extract_result(self,
-                           task: TaskType,
-                           three_agents = {},
-                           construct = {},
-                           instruction: str = "",
-                           text: str = "",
-                           output_schema: str = "",
-                           constraint: str = "",
-                           use_file: bool = False,
-                           file_path: str = "",
-                           truth: str = "",
-                           mode: str = "quick",
-                           update_case: bool = False,
-                           show_trajectory: bool = False,
-                           isgui: bool = False,
-                           iskg: bool = False,
-                           config_name: str = "", 
-                           ):
-
+    def __prepare(self, task, three_agents, instruction, text, output_schema, constraint, use_file, file_path, truth, mode, update_case, isgui, shared_work=None):
         # Check Consistancy
         mode, update_case = self.__check_consistancy(self.llm, task, mode, update_case)
 
         # Load Data
         data = DataPoint(task=task, instruction=instruction, text=text, output_schema=output_schema, constraint=constraint, use_file=use_file, file_path=file_path, truth=truth)
         data = self.__init_data(data)
+        data.shared_work = shared_work
         if mode in config['agent']['mode'].keys():
             process_method = config['agent']['mode'][mode].copy()
         else:
@@ -92,40 +83,9 @@ class Pipeline:
 
         sorted_process_method = self.__init_method(data, process_method)
         print("Process Method: ", sorted_process_method)
+        return data, sorted_process_method, update_case
 
-        print_schema = False #
-        frontend_schema = "" #
-        frontend_res = "" #
-
-        # Information Extract
-        for agent_name, method_name in sorted_process_method.items():
-            agent = getattr(self, agent_name, None)
-            if not agent:
-                continue
-            method = getattr(agent, method_name, None)
-            if not method:
-                continue
-            data = method(data)
-            if not print_schema and data.print_schema: #
-                print("Schema: \n", data.print_schema)
-                frontend_schema = data.print_schema
-                print_schema = True
-        # Only call summarize_answer if extraction_agent is available
-        if self.extraction_agent is not None:
-            data = self.extraction_agent.summarize_answer(data)
-        else:
-            # If no extraction agent, set an empty result based on task type
-            if data.task == "NER":
-                data.pred = []
-            elif data.task == "RE":
-                data.pred = []
-            elif data.task == "EE":
-                data.pred = []
-            elif data.task == "Triple":
-                data.pred = []
-            else:
-                data.pred = []
-
+    def __finalize(self, data: DataPoint, frontend_schema, construct, update_case, show_trajectory, isgui, iskg, config_name):
         # show result
         if not isgui:
             if show_trajectory:
@@ -175,10 +135,125 @@ class Pipeline:
                         data.truth = data.pred
                     else:
                         data.truth = extract_json_dict(truth)
-                self.case_repo.update_case(data)
+                if config['agent']['case_update_mode'] == "background":
+                    self.case_repo.submit_update(data)
+                else:
+                    self.case_repo.update_case(data)
 
         # return result
         result = data.pred
         trajectory = data.get_result_trajectory()
 
         return result, trajectory, frontend_schema, frontend_res
+
+    # main entry
+    def get_extract_result(self,
+                           task: TaskType,
+                           three_agents = {},
+                           construct = {},
+                           instruction: str = "",
+                           text: str = "",
+                           output_schema: str = "",
+                           constraint: str = "",
+                           use_file: bool = False,
+                           file_path: str = "",
+                           truth: str = "",
+                           mode: str = "quick",
+                           update_case: bool = False,
+                           show_trajectory: bool = False,
+                           isgui: bool = False,
+                           iskg: bool = False,
+                           config_name: str = "", 
+                           shared_work: dict = None,
+                           ):
+
+        data, sorted_process_method, update_case = self.__prepare(task, three_agents, instruction, text, output_schema, constraint, use_file, file_path, truth, mode, update_case, isgui, shared_work)
+
+        print_schema = False #
+        frontend_schema = "" #
+
+        # Information Extract
+        for agent_name, method_name in sorted_process_method.items():
+            agent = getattr(self, agent_name, None)
+            if not agent:
+                continue
+            method = getattr(agent, method_name, None)
+            if not method:
+                continue
+            data = method(data)
+            if not print_schema and data.print_schema: #
+                print("Schema: \n", data.print_schema)
+                frontend_schema = data.print_schema
+                print_schema = True
+        # Only call summarize_answer if extraction_agent is available
+        if self.extraction_agent is not None:
+            data = self.extraction_agent.summarize_answer(data)
+        else:
+            # If no extraction agent, set an empty result
+            data.pred = []
+
+        return self.__finalize(data, frontend_schema, construct, update_case, show_trajectory, isgui, iskg, config_name)
+
+    # batch entry: each item holds the keyword arguments of get_extract_result
+    def get_extract_results(self, items: list, max_concurrency: int = 4, share_schema: bool = False):
+        # share_schema: documents with the same task, instruction and output schema share one deduced schema (one deduction call)
+        shared_work = {} if share_schema else None
+
+        def extract_item(item):
+            # Capture the failure in place of the result so one bad item does not abort the batch
+            try:
+                return self.get_extract_result(**item, shared_work=shared_work)
+            except Exception as e:
+                print(f"Error when extracting item: {e}")
+                return e
+
+        return parallel_map(extract_item, items, max_workers=max_concurrency)
+
+    # async entry: same arguments and return value as get_extract_result
+    async def aget_extract_result(self,
+                                  task: TaskType,
+                                  three_agents = {},
+                                  construct = {},
+                                  instruction: str = "",
+                                  text: str = "",
+                                  output_schema: str = "",
+                                  constraint: str = "",
+                                  use_file: bool = False,
+                                  file_path: str = "",
+                                  truth: str = "",
+                                  mode: str = "quick",
+                                  update_case: bool = False,
+                                  show_trajectory: bool = False,
+                                  isgui: bool = False,
+                                  iskg: bool = False,
+                                  config_name: str = "",
+                                  ):
+
+        data, sorted_process_method, update_case = self.__prepare(task, three_agents, instruction, text, output_schema, constraint, use_file, file_path, truth, mode, update_case, isgui)
+
+        print_schema = False
+        frontend_schema = ""
+
+        # Information Extract: prefer the agent's coroutine ("a" + method name), else run the stage in a thread
+        for agent_name, method_name in sorted_process_method.items():
+            agent = getattr(self, agent_name, None)
+            if not agent:
+                continue
+            method = getattr(agent, method_name, None)
+            if not method:
+                continue
+            async_method = getattr(agent, f"a{method_name}", None)
+            if async_method is not None:
+                data = await async_method(data)
+            else:
+                data = await asyncio.to_thread(method, data)
+            if not print_schema and data.print_schema:
+                print("Schema: \n", data.print_schema)
+                frontend_schema = data.print_schema
+                print_schema = True
+        if self.extraction_agent is not None:
+            data = await self.extraction_agent.asummarize_answer(data)
+        else:
+            data.pred = []
+
+        return await asyncio.to_thread(self.__finalize, data, frontend_schema, construct, update_case, show_trajectory, isgui, iskg, config_name)
@@ -32,6 +32,12 @@ def main():
             model = clazz(model_config['model_name_or_path'])
         else:
             model = clazz(model_config['model_name_or_path'], model_config['api_key'], model_config['base_url'])
+    if model_config['structured_output']:
+        model.set_structured_output(True)
+    if model_config['stream']:
+        model.set_streaming(True)
+    if model_config['cache_path'] != "":
+        model = CachedEngine(model, cache_path=model_config['cache_path'], replay=model_config['cache_replay'])
     pipeline = Pipeline(model)
     # Extraction config
     extraction_config = config['extraction']
@@ -40,11 +46,14 @@ def main():
         construct_config = config['construct']
         result, trajectory, _, _ = pipeline.get_extract_result(task=extraction_config['task'], instruction=extraction_config['instruction'], text=extraction_config['text'], output_schema=extraction_config['output_schema'], constraint=extraction_config['constraint'], use_file=extraction_config['use_file'], file_path=extraction_config['file_path'], truth=extraction_config['truth'], mode=extraction_config['mode'], update_case=extraction_config['update_case'], show_trajectory=extraction_config['show_trajectory'],
                                                                construct=construct_config, iskg=True,config_name=args.config) # When 'construct' is provided, 'iskg' should be True to construct the knowledge graph.
+        pipeline.case_repo.flush()
         return
     else:
         print("please provide construct config in the yaml file.")
 
     result, trajectory, _, _ = pipeline.get_extract_result(task=extraction_config['task'], instruction=extraction_config['instruction'], text=extraction_config['text'], output_schema=extraction_config['output_schema'], constraint=extraction_config['constraint'], use_file=extraction_config['use_file'], file_path=extraction_config['file_path'], truth=extraction_config['truth'], mode=extraction_config['mode'], update_case=extraction_config['update_case'], show_trajectory=extraction_config['show_trajectory'],config_name=args.config)
+    # Wait for the case learned in the background before exiting
+    pipeline.case_repo.flush()
     return
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
+import copy
 from typing import Literal
-from models import *
 from .process import *
 # predefined processing logic for routine extraction tasks
 TaskType = Literal["NER", "RE", "EE", "Base"]
@@ -28,13 +28,24 @@ class DataPoint:
         self.truth = extract_json_dict(truth)
         # temp storage
         self.print_schema = ""
+        self.schema_model = None # pydantic model that chunk results are validated against
         self.distilled_text = ""
         self.chunk_text_list = []
+        self.retrieval_cache = {} # query embeddings and top-k case results, reused within this request
+        self.shared_work = None # schema work shared with the other documents of a get_extract_results batch
         # result feedback
         self.result_list = []
         self.result_trajectory = {}
         self.pred = ""
 
+    def __deepcopy__(self, memo):
+        # shared_work holds the futures of the whole batch; a copy (e.g. queued for case learning) does not take part in it
+        clone = self.__class__.__new__(self.__class__)
+        memo[id(self)] = clone
+        for key, value in self.__dict__.items():
+            setattr(clone, key, None if key == "shared_work" else copy.deepcopy(value, memo))
+        return clone
+
     def set_constraint(self, constraint):
         self.constraint = constraint
 
@@ -7,7 +7,14 @@ Supports:
 from langchain_community.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader, BSHTMLLoader, JSONLoader
 from nltk.tokenize import sent_tokenize
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from pypdf import PdfReader
+from pydantic import ValidationError
+from .text_scan import JSONScanner, CJK_CHAR_PATTERN
 import re
+import copy
+import asyncio
+import multiprocessing
 import json
 import yaml
 import os
@@ -38,6 +45,10 @@ def load_extraction_config(yaml_path):
     api_key = model_config.get('api_key', "")
     base_url = model_config.get('base_url', "")
     vllm_serve = model_config.get('vllm_serve', False)
+    cache_path = model_config.get('cache_path', "")
+    cache_replay = model_config.get('cache_replay', False)
+    structured_output = model_config.get('structured_output', False)
+    stream = model_config.get('stream', False)
 
     # Extraction config
     task = extraction_config.get('task', "")
@@ -66,7 +77,11 @@ def load_extraction_config(yaml_path):
                 "category": model_category,
                 "api_key": api_key,
                 "base_url": base_url,
-                "vllm_serve": vllm_serve
+                "vllm_serve": vllm_serve,
+                "cache_path": cache_path,
+                "cache_replay": cache_replay,
+                "structured_output": structured_output,
+                "stream": stream
             },
             "extraction": {
                 "task": task,
@@ -96,7 +111,11 @@ def load_extraction_config(yaml_path):
             "category": model_category,
             "api_key": api_key,
             "base_url": base_url,
-            "vllm_serve": vllm_serve
+            "vllm_serve": vllm_serve,
+            "cache_path": cache_path,
+            "cache_replay": cache_replay,
+            "structured_output": structured_output,
+            "stream": stream
         },
         "extraction": {
             "task": task,
@@ -113,31 +132,93 @@ def load_extraction_config(yaml_path):
         }
     }
 
-# Split the string text into chunks
-def chunk_str(text):
-    sentences = sent_tokenize(text)
-    chunks = []
+# Chunk size in tokens: fixed from config, or derived from the engine's context window
+def get_chunk_token_limit(llm=None, prompt_overhead=0):
+    limit = config['agent']['chunk_token_limit']
+    if limit != "auto":
+        return limit
+    if llm is None:
+        return 1024
+    budget = llm.context_length - llm.max_tokens - prompt_overhead - config['agent']['chunk_prompt_reserve']
+    return max(128, min(budget, config['agent']['chunk_token_cap']))
+
+# Sentence ends at CJK or Latin terminal punctuation (plus closing quotes/brackets) or at a line break
+CJK_SENTENCE_PATTERN = re.compile(r'[^。！？；!?…\n]*(?:[。！？；!?…]+[”’」』）)\]"]*|\n+|$)')
+
+# Detect CJK text from the share of CJK characters in a prefix sample
+def is_cjk_text(text, sample_size=2000, threshold=0.2):
+    sample = ''.join(text[:sample_size].split())
+    if not sample:
+        return False
+    return len(CJK_CHAR_PATTERN.findall(sample)) / len(sample) >= threshold
+
+def split_sentences(text):
+    if not is_cjk_text(text):
+        return sent_tokenize(text)
+    # Fast regex path: NLTK's punkt model does not know CJK punctuation
+    return [sentence.strip() for sentence in CJK_SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+# Length without a tokenizer: every CJK character counts as one unit, other text by whitespace words
+def count_words(sentence):
+    cjk_count = len(CJK_CHAR_PATTERN.findall(sentence))
+    if cjk_count == 0:
+        return len(sentence.split())
+    return cjk_count + len(CJK_CHAR_PATTERN.sub(' ', sentence).split())
+
+# Yield complete sentences in batches while pages stream in; a sentence cut by a page break is carried over
+def iter_sentence_batches(pages):
+    pending = ""
+    for page in pages:
+        pending += page
+        sentences = split_sentences(pending)
+        if len(sentences) > 1:
+            yield sentences[:-1]
+            last_start = pending.rfind(sentences[-1])
+            pending = pending[last_start:] if last_start >= 0 else sentences[-1]
+    sentences = split_sentences(pending)
+    if sentences:
+        yield sentences
+
+# Pack streamed sentences into chunks, yielding each chunk as soon as it is full
+def iter_chunks(pages, token_limit=None, count_tokens=None, overlap=None):
+    token_limit = get_chunk_token_limit() if token_limit is None else token_limit
+    overlap = config['agent']['chunk_sentence_overlap'] if overlap is None else overlap
+    separator = None
     current_chunk = []
+    current_counts = []
     current_length = 0
 
-    for sentence in sentences:
-        token_count = len(sentence.split())
-        if current_length + token_count <= config['agent']['chunk_token_limit']:
-            current_chunk.append(sentence)
-            current_length += token_count
+    for sentences in iter_sentence_batches(pages):
+        if separator is None:
+            separator = '' if is_cjk_text(''.join(sentences)) else ' '
+        if count_tokens is None:
+            token_counts = [count_words(sentence) for sentence in sentences]
         else:
-            if current_chunk:
-                chunks.append(' '.join(current_chunk))
-            current_chunk = [sentence]
-            current_length = token_count
+            token_counts = count_tokens(sentences)
+        for sentence, token_count in zip(sentences, token_counts):
+            if current_length + token_count <= token_limit:
+                current_chunk.append(sentence)
+                current_counts.append(token_count)
+                current_length += token_count
+            else:
+                if current_chunk:
+                    yield separator.join(current_chunk)
+                # Carry the last sentences over as context when they still fit with the new one
+                carried = current_chunk[-overlap:] if overlap > 0 else []
+                carried_counts = current_counts[-overlap:] if overlap > 0 else []
+                if sum(carried_counts) + token_count > token_limit:
+                    carried, carried_counts = [], []
+                current_chunk = carried + [sentence]
+                current_counts = carried_counts + [token_count]
+                current_length = sum(current_counts)
     if current_chunk:
-        chunks.append(' '.join(current_chunk))
-    return chunks
+        yield separator.join(current_chunk)
 
-# Load and split the content of a file
-def chunk_file(file_path):
-    pages = []
+# Split the string text into chunks
+def chunk_str(text, token_limit=None, count_tokens=None, overlap=None):
+    return list(iter_chunks([text], token_limit=token_limit, count_tokens=count_tokens, overlap=overlap))
 
+def get_file_loader(file_path):
     if file_path.endswith(".pdf"):
         loader = PyPDFLoader(file_path)
     elif file_path.endswith(".txt"):
@@ -151,14 +232,102 @@ def chunk_file(file_path):
         loader = JSONLoader(file_path)
     else:
         raise ValueError("Unsupported file format")  # Inform that the format is unsupported
+    return loader
 
-    pages = loader.load_and_split()
-    docs = ""
-    for item in pages:
-        docs += item.page_content
-    pages = chunk_str(docs)
+# Extract the text of pages [start, end) of a PDF; runs in a worker process
+def extract_pdf_pages(file_path, start, end):
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
 
-    return pages
+# Start context for the PDF workers: forking this (multithreaded) process could copy a held lock into them,
+# so they come from a fresh fork server where available, else are spawned
+def get_pdf_process_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+# Parse a PDF across a process pool and yield page texts in page order as soon as each range is ready
+def iter_pdf_pages_parallel(file_path, max_workers=None, pages_per_task=None):
+    max_workers = config['agent']['pdf_parse_workers'] if max_workers is None else max_workers
+    pages_per_task = config['agent']['pdf_pages_per_task'] if pages_per_task is None else pages_per_task
+    page_count = len(PdfReader(file_path).pages)
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    workers = min(max_workers, os.cpu_count() or 1, len(ranges))
+    if workers <= 1:
+        for start, end in ranges:
+            for text in extract_pdf_pages(file_path, start, end):
+                yield text + "\n"
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_pdf_process_context()) as executor:
+        # Keep a bounded window of ranges in flight so parsed text does not pile up ahead of the chunker
+        pending = []
+        next_range = 0
+        while pending or next_range < len(ranges):
+            while next_range < len(ranges) and len(pending) < 2 * workers:
+                pending.append(executor.submit(extract_pdf_pages, file_path, *ranges[next_range]))
+                next_range += 1
+            for text in pending.pop(0).result():
+                yield text + "\n"
+
+# Lazily yield the text of a file page by page (PDF) or block by block (TXT)
+def iter_file_pages(file_path, block_size=65536):
+    if file_path.endswith(".pdf") and config['agent']['pdf_parse_workers'] > 1:
+        yield from iter_pdf_pages_parallel(file_path)
+        return
+    if file_path.endswith(".txt"):
+        with open(file_path, encoding='utf-8') as file:
+            while True:
+                block = file.read(block_size)
+                if not block:
+                    break
+                yield block
+        return
+    for document in get_file_loader(file_path).lazy_load():
+        yield document.page_content + "\n"
+
+# Stream chunks of a file as soon as they fill, holding only a few pages in memory
+def iter_file_chunks(file_path, token_limit=None, count_tokens=None, overlap=None):
+    return iter_chunks(iter_file_pages(file_path), token_limit=token_limit, count_tokens=count_tokens, overlap=overlap)
+
+# Load and split the content of a file
+def chunk_file(file_path, token_limit=None, count_tokens=None, overlap=None):
+    return list(iter_file_chunks(file_path, token_limit=token_limit, count_tokens=count_tokens, overlap=overlap))
+
+# Apply func to every item with a thread pool, keeping input order; a failing item yields a copy of default
+def parallel_map(func, items, max_workers=8, default=None):
+    items = list(items)
+    results = [None] * len(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for idx, item in enumerate(items):
+            try:
+                results[idx] = func(item)
+            except Exception as e:
+                print(f"Error when processing item {idx}: {e}")
+                results[idx] = copy.deepcopy(default)
+        return results
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        futures = {pool.submit(func, item): idx for idx, item in enumerate(items)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                print(f"Error when processing item {idx}: {e}")
+                results[idx] = copy.deepcopy(default)
+    return results
+
+async def gather_map(awaitables, default=None):
+    # Async counterpart of parallel_map: results in order, a failing awaitable yields default instead of failing the rest
+    results = list(await asyncio.gather(*awaitables, return_exceptions=True))
+    for idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Error when processing item {idx}: {result}")
+            results[idx] = copy.deepcopy(default)
+        elif isinstance(result, BaseException):
+            raise result
+    return results
 
 def process_single_quotes(text):
     result = re.sub(r"(?<!\w)'|'(?!\w)", '"', text)
@@ -182,25 +351,191 @@ def remove_empty_values(data):
     else:
         return data
 
+JSON_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+JSON_NUMBER_PATTERN = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+JSON_WORD_PATTERN = re.compile(r'[^\s,:{}\[\]"\'`]+')
+JSON_CLOSERS = {'{': '}', '[': ']'}
+
+# Rewrite common breakage in model JSON: code fences, single quotes, unquoted keys, Python literals, trailing commas and missing closers
+def repair_json(text):
+    out = []
+    stack = []
+    commas = []  # (position in out, open containers) of every comma, to drop a truncated last element
+    cut_string = False  # the text ended inside a string
+    pos, end = 0, len(text)
+    while pos < end:
+        char = text[pos]
+        if char in '{[':
+            stack.append(char)
+            out.append(char)
+            pos += 1
+        elif char in '}]':
+            if not stack:
+                break
+            while out and (out[-1].isspace() or out[-1] == ','):
+                out.pop()
+            out.append(JSON_CLOSERS[stack.pop()])
+            pos += 1
+            if not stack:
+                break
+        elif char == '"' or char == "'":
+            # Read a string, re-emitting single-quoted ones with double quotes
+            chars = []
+            pos += 1
+            while pos < end and text[pos] != char:
+                if text[pos] == '\\' and pos + 1 < end:
+                    if text[pos + 1] == "'" and char == "'":
+                        chars.append("'")
+                    else:
+                        chars.append(text[pos:pos + 2])
+                    pos += 2
+                    continue
+                chars.append('\\"' if text[pos] == '"' else text[pos])
+                pos += 1
+            cut_string = pos >= end
+            out.append('"' + ''.join(chars) + '"')
+            pos += 1
+        elif char == ',':
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] not in ('{', '[', ','):
+                commas.append((len(out), len(stack)))
+                out.append(',')
+            pos += 1
+        elif char == '`':
+            pos += 1
+        elif char.isspace() or char == ':':
+            out.append(char)
+            pos += 1
+        else:
+            word = JSON_WORD_PATTERN.match(text, pos).group()
+            pos += len(word)
+            if word in JSON_LITERALS:
+                out.append(JSON_LITERALS[word])
+            elif JSON_NUMBER_PATTERN.fullmatch(word):
+                out.append(word)
+            else:
+                # Unquoted key or bare string value
+                out.append(json.dumps(word, ensure_ascii=False))
+
+    def close(out, stack):
+        out = list(out)
+        while out and (out[-1].isspace() or out[-1] == ','):
+            out.pop()
+        if out and out[-1] == ':':
+            out.append('null')
+        return ''.join(out) + ''.join(JSON_CLOSERS[opener] for opener in reversed(stack))
+
+    repaired = close(out, stack)
+    if not stack:
+        return repaired
+    # Truncated inside a string, right after a key, or on a key without its colon: the last element is only a fragment
+    # (e.g. {"name": "Bo), so drop it back to the previous comma instead of keeping a half entity
+    tokens = [token for token in out if not token.isspace()]
+    after_key = bool(tokens) and (tokens[-1] == ':' or (stack[-1] == '{' and tokens[-1].startswith('"') and (len(tokens) < 2 or tokens[-2] in ('{', ','))))
+    if (cut_string or after_key) and commas:
+        comma, depth = commas.pop()
+        repaired = close(out[:comma], stack[:depth])
+    # If the last element is still incomplete, drop elements back to an earlier comma
+    for comma, depth in reversed(commas[-3:]):
+        try:
+            json.loads(repaired, strict=False)
+            break
+        except json.JSONDecodeError:
+            repaired = close(out[:comma], stack[:depth])
+    return repaired
+
+def parse_json_object(text):
+    for candidate in (text, repair_json(text)):
+        try:
+            json_dict = json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(json_dict, dict):
+            return json_dict
+    return None
+
 def extract_json_dict(text):
     if isinstance(text, dict):
         return text
-    pattern = r'\{(?:[^{}]|(?:\{(?:[^{}]|(?:\{[^{}]*\})*)*\})*)*\}'
-    matches = re.findall(pattern, text)
-    if matches:
-        json_string = matches[-1]
-        json_string = json_string.encode('utf-8').decode('unicode_escape')
-        # json_string = process_single_quotes(json_string)
+    if text.lstrip().startswith('{') and text.rstrip().endswith('}'):
+        # Structured-output engines return the bare object, which parses directly
         try:
-            json_dict = json.loads(json_string)
-            json_dict = remove_empty_values(json_dict)
-            if json_dict is None:
-                return "No valid information found."
-            return json_dict
+            json_dict = json.loads(text)
+            if isinstance(json_dict, dict):
+                return remove_empty_values(json_dict)
         except json.JSONDecodeError:
-            return json_string
-    else:
+            pass
+    scanner = JSONScanner()
+    scanner.feed(text)
+    # An object left open around the last closed one is usually the answer cut short, so it is tried first;
+    # a stray brace opened after a complete answer is only a fallback
+    open_first = scanner.span is None or (scanner.stack and scanner.stack[0] < scanner.span[0])
+    order = (scanner.open_object, scanner.last_object) if open_first else (scanner.last_object, scanner.open_object)
+    candidates = [candidate for candidate in order if candidate is not None]
+    if not candidates:
         return text
+    parsed = [json_dict for json_dict in map(parse_json_object, candidates) if json_dict is not None]
+    if not parsed:
+        return scanner.last_object if scanner.last_object is not None else text
+    json_dict = next((json_dict for json_dict in parsed if json_dict), parsed[0])
+    json_dict = remove_empty_values(json_dict)
+    if json_dict is None:
+        return "No valid information found."
+    return json_dict
+
+# Whether a response is mostly a JSON object rather than prose that happens to quote one
+def is_bare_json(text):
+    scanner = JSONScanner()
+    scanner.feed(text)
+    json_string = scanner.last_object if scanner.last_object is not None else scanner.open_object
+    if json_string is None or parse_json_object(json_string) is None:
+        return False
+    prose = re.sub(r'```\w*', '', text.replace(json_string, '')).strip()
+    return len(prose) < len(json_string)
+
+# Coerce a parsed result towards a JSON schema: numbers to strings, single values to lists
+def coerce_to_schema(value, schema, defs):
+    if "$ref" in schema:
+        schema = defs.get(schema["$ref"].split("/")[-1], {})
+    if "anyOf" in schema:
+        if value is None:
+            return value
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return coerce_to_schema(value, options[0], defs) if len(options) == 1 else value
+    schema_type = schema.get("type")
+    if schema_type == "object" and isinstance(value, dict):
+        properties = schema.get("properties", {})
+        return {key: coerce_to_schema(item, properties[key], defs) if key in properties else item for key, item in value.items()}
+    if schema_type == "array" and value is not None:
+        items = value if isinstance(value, list) else [value]
+        return [coerce_to_schema(item, schema.get("items", {}), defs) for item in items]
+    if schema_type == "string" and isinstance(value, (int, float)):
+        return json.dumps(value)
+    return value
+
+# Validate a parsed result against a pydantic model; returns the coerced result and the errors a re-ask should fix
+def validate_json(result, schema_model):
+    if not isinstance(result, dict):
+        return result, ["The answer is not a valid JSON object."]
+    if schema_model is None or not result:
+        return result, []
+    json_schema = schema_model.model_json_schema()
+    properties = json_schema.get("properties", {})
+    if properties and not any(key in result for key in properties):
+        return result, [f"The JSON object must use the fields {list(properties)}."]
+    result = coerce_to_schema(result, json_schema, json_schema.get("$defs", {}))
+    # An absent top-level list only means the chunk has no such items; any other missing required field is reported
+    filled = dict(result)
+    for key, field_schema in properties.items():
+        if key not in filled and field_schema.get("type") == "array":
+            filled[key] = []
+    try:
+        schema_model.model_validate(filled)
+    except ValidationError as e:
+        errors = [f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in e.errors()]
+        return result, errors
+    return result, []
 
 def good_case_wrapper(example: str):
     if example is None or example == "":
@@ -277,3 +612,50 @@ def dict_list_to_set(data_list):
     except Exception as e:
         print (f"Failed to convert dictionary list to set: {data_list}")
         return result_set
+
+# list key, identity fields and majority-voted type fields of each fixed-schema task;
+# events keep their arguments in the identity, so two events sharing a trigger both survive
+MERGE_SPECS = {
+    "NER": ("entity_list", ["name"], ["type"]),
+    "RE": ("relation_list", ["head", "relation", "tail"], []),
+    "EE": ("event_list", ["event_trigger", "event_argument"], ["event_type"]),
+    "Triple": ("triple_list", ["head", "relation", "tail"], ["head_type", "relation_type", "tail_type"]),
+}
+
+def merge_results(task, result_list):
+    if task not in MERGE_SPECS:
+        return None
+    list_key, identity_fields, type_fields = MERGE_SPECS[task]
+    merged = {}
+    found = False
+    for result in result_list:
+        if not isinstance(result, dict) or not isinstance(result.get(list_key), list):
+            continue
+        found = True
+        for item in result[list_key]:
+            if not isinstance(item, dict):
+                continue
+            if all(field in item for field in identity_fields):
+                identity = tuple(normalize_obj(item[field]) for field in identity_fields)
+            else:
+                identity = normalize_obj(item)
+            if identity not in merged:
+                merged[identity] = {"item": item, "votes": {field: Counter() for field in type_fields}, "originals": {}}
+            entry = merged[identity]
+            for field in type_fields:
+                if field in item:
+                    normalized = normalize_obj(item[field])
+                    entry["votes"][field][normalized] += 1
+                    entry["originals"].setdefault((field, normalized), item[field])
+    if not found:
+        return None
+    merged_list = []
+    for entry in merged.values():
+        item = dict(entry["item"])
+        for field, votes in entry["votes"].items():
+            if votes:
+                # most_common keeps first-seen order on ties
+                winner = votes.most_common(1)[0][0]
+                item[field] = entry["originals"][(field, winner)]
+        merged_list.append(item)
+    return {list_key: merged_list}
@@ -0,0 +1,106 @@
+"""
+Dependency-free Text Scanning.
+Supports:
+- An incremental, string-aware scanner for JSON objects embedded in model output
+- Detecting when a streamed answer's JSON object has closed
+- CJK character matching, shared by sentence splitting and tokenizer-free token estimates
+"""
+
+import re
+
+CJK_CHAR_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+# Single-pass, string-aware scanner for JSON objects embedded in model output; text can be fed incrementally
+class JSONScanner:
+    TOKEN_PATTERN = re.compile(r'[{}]|"(?:[^"\\]|\\.)*(")?', re.DOTALL)
+    STRING_PATTERN = re.compile(r'(?:[^"\\]|\\.)*(")?', re.DOTALL)
+
+    def __init__(self):
+        self.pieces = []  # fed text since the outermost open brace
+        self.base = 0  # absolute offset of pieces[0]
+        self.offset = 0  # absolute offset of the end of the fed text
+        self.stack = []  # absolute offsets of the open braces
+        self.in_string = False
+        self.escaped = False  # a backslash ended the last piece inside a string
+        self.span = None  # most recently closed object, the outermost one closed so far
+        self._last_object = None
+        self.completed = 0  # number of top-level objects closed
+
+    @property
+    def complete(self):
+        return self.completed > 0 and not self.stack
+
+    @property
+    def last_object(self):
+        if self._last_object is None and self.span is not None:
+            text = ''.join(self.pieces)
+            self.pieces = [text]
+            self._last_object = text[self.span[0] - self.base:self.span[1] - self.base]
+        return self._last_object
+
+    @property
+    def open_object(self):
+        # Text of the outermost object still open, e.g. a response cut off by max_tokens
+        if not self.stack:
+            return None
+        return ''.join(self.pieces)[self.stack[0] - self.base:]
+
+    def __close(self, end):
+        self.span = (self.stack.pop(), end)
+        self._last_object = None
+        if not self.stack:
+            self.completed += 1
+            # Materialize before the pieces are dropped
+            self.last_object
+
+    def feed(self, text):
+        """Scan the next piece of text; returns whether a top-level object has been closed and none is open."""
+        start_offset = self.offset
+        self.offset += len(text)
+        self.pieces.append(text)
+        pos, end = 0, len(text)
+        if self.escaped and end:
+            pos, self.escaped = 1, False
+        while pos < end:
+            if self.in_string:
+                match = self.STRING_PATTERN.match(text, pos)
+                pos = match.end()
+                if match.group(1):
+                    self.in_string = False
+                elif pos < end:
+                    # Only a trailing backslash stops the match early; its escaped character comes next
+                    self.escaped, pos = True, end
+            elif not self.stack:
+                brace = text.find('{', pos)
+                if brace == -1:
+                    break
+                self.stack.append(start_offset + brace)
+                pos = brace + 1
+            else:
+                match = self.TOKEN_PATTERN.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                token = match.group()
+                if token == '{':
+                    self.stack.append(start_offset + match.start())
+                elif token == '}':
+                    self.__close(start_offset + pos)
+                elif not match.group(1):
+                    self.in_string = True
+                    if pos < end:
+                        self.escaped, pos = True, end
+        if not self.stack:
+            # Nothing open: the scanned text is no longer needed
+            self.pieces = []
+            self.base = self.offset
+        return self.complete
+
+def answer_closed(text, scanner, schema=None):
+    # The first top-level object is the whole answer when a schema was requested or only a code fence precedes it;
+    # prose that merely quotes JSON (e.g. case analyses) keeps streaming
+    if not scanner.complete:
+        return False
+    if schema is not None:
+        return True
+    return re.sub(r'```\w*', '', text[:text.find('{')]).strip() == ""